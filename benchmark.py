@@ -0,0 +1,261 @@
+import pymupdf
+import os
+import sys
+import json
+import random
+import platform
+import datetime
+import tempfile
+import multiprocessing
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+import click
+from rich.table import Table
+import main
+from main import console, debug_print, format_size
+
+try:
+    import resource # not available on windows
+except ImportError:
+    resource = None
+
+# Benchmarks pdf_to_epub and extract_pdf on synthetic PDFs.
+#   python benchmark.py -o bench_results.json
+#   python benchmark.py --baseline bench_results.json --threshold 0.1
+# Corpora are generated once into --corpus-dir and reused. Bump CORPUS_VERSION when a generator changes
+# so results are never compared across different corpora.
+
+CORPUS_VERSION = 1
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore "
+         "magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo").split()
+FONTS = {(False, False): pymupdf.Font("helv"), (True, False): pymupdf.Font("hebo"),
+         (False, True): pymupdf.Font("heit"), (True, True): pymupdf.Font("hebi")}
+TARGETS = ("pdf_to_epub", "extract_pdf")
+
+
+def write_text_page(page, rng, lines=38, fontsize=10):
+    """Fills the page with lines of words where short runs of words are bold and/or italic."""
+    writer = pymupdf.TextWriter(page.rect)
+    writer.append((72, 40), "Running header of the synthetic book", font=FONTS[(False, False)], fontsize=8)
+    y = 72
+    for _ in range(lines):
+        position = pymupdf.Point(72, y)
+        style = (False, False)
+        for _ in range(rng.randint(8, 12)):
+            if rng.random() < 0.15:
+                style = (rng.random() < 0.5, rng.random() < 0.5)
+            _, position = writer.append(position, f"{rng.choice(WORDS)} ", font=FONTS[style], fontsize=fontsize)
+        y += fontsize * 1.6
+    writer.append((page.rect.width / 2, page.rect.height - 30), str(page.number + 1), font=FONTS[(False, False)], fontsize=8)
+    writer.write_text(page)
+
+def make_image(rng, width, height, fmt):
+    # upscaled noise compresses like a photo instead of like pure noise
+    small = pymupdf.Pixmap(pymupdf.csRGB, width // 16, height // 16, rng.randbytes((width // 16) * (height // 16) * 3), False)
+    return pymupdf.Pixmap(small, width, height).tobytes(fmt)
+
+def make_text(doc, rng):
+    toc = []
+    for p in range(300):
+        write_text_page(doc.new_page(), rng)
+        if p % 10 == 0:
+            toc.append([1, f"Chapter {p // 10 + 1}", p + 1])
+    doc.set_toc(toc)
+
+def make_images(doc, rng):
+    toc = []
+    for p in range(100):
+        page = doc.new_page()
+        write_text_page(page, rng, lines=6)
+        # a unique image on every page, every 4th one is a png
+        page.insert_image(pymupdf.Rect(72, 200, 540, 550), stream=make_image(rng, 1000, 750, "png" if p % 4 == 0 else "jpeg"))
+        if p % 10 == 0:
+            toc.append([1, f"Gallery {p // 10 + 1}", p + 1])
+    doc.set_toc(toc)
+
+def make_logos(doc, rng):
+    logo = make_image(rng, 320, 160, "png")
+    ornament = make_image(rng, 480, 160, "jpeg")
+    toc = []
+    for p in range(300):
+        page = doc.new_page()
+        write_text_page(page, rng, lines=30)
+        page.insert_image(pymupdf.Rect(72, 20, 152, 60), stream=logo) # header logo, ignored
+        page.insert_image(pymupdf.Rect(200, 560, 400, 627), stream=ornament) # repeated body image, kept once
+        page.insert_image(pymupdf.Rect(450, 770, 530, 810), stream=logo) # footer logo, ignored
+        if p % 10 == 0:
+            toc.append([1, f"Chapter {p // 10 + 1}", p + 1])
+    doc.set_toc(toc)
+
+def make_deep_toc(doc, rng):
+    toc = []
+    for p in range(600):
+        write_text_page(doc.new_page(), rng, lines=20)
+        # part / chapter / section / subsection
+        for level, every in ((1, 120), (2, 30), (3, 10), (4, 2)):
+            if p % every == 0:
+                toc.append([level, f"Level {level} entry at page {p + 1}", p + 1])
+    doc.set_toc(toc)
+
+def make_large(doc, rng):
+    # no TOC, so the whole book is one chapter
+    for p in range(1500):
+        write_text_page(doc.new_page(), rng, lines=30)
+
+CORPORA = {
+    "text": make_text,
+    "images": make_images,
+    "logos": make_logos,
+    "deep_toc": make_deep_toc,
+    "large": make_large,
+}
+
+def get_corpus(corpus_dir, name):
+    """Path of the synthetic PDF for name, generated on first use."""
+    pdf_path = os.path.join(corpus_dir, f"{name}_v{CORPUS_VERSION}.pdf")
+    if os.path.isfile(pdf_path):
+        return pdf_path
+
+    debug_print("info", f"Generating {pdf_path}...")
+    os.makedirs(corpus_dir, exist_ok=True)
+    doc = pymupdf.open()
+    CORPORA[name](doc, random.Random(f"{name}-{CORPUS_VERSION}"))
+    doc.set_metadata({"title": f"Benchmark {name}", "author": "pdf2epub benchmark"})
+    doc.save(f"{pdf_path}.tmp", garbage=3, deflate=True)
+    doc.close()
+    os.replace(f"{pdf_path}.tmp", pdf_path)
+    return pdf_path
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # bytes on macOS, KB on linux
+
+def run_case(pdf_path, target):
+    """Runs one measurement. This runs in a fresh process, so the peak RSS belongs to this run only."""
+    console.quiet = True
+    main.CACHE_DIR = None # measure the conversion, not the page cache
+    main.SHOULD_OVERWRITE = True
+    doc = pymupdf.open(pdf_path)
+    page_count = doc.page_count
+
+    with tempfile.TemporaryDirectory() as output:
+        time_start = perf_counter()
+        if target == "pdf_to_epub":
+            doc.close()
+            status, detail = main.pdf_to_epub(pdf_path, output)
+            if status != "converted":
+                raise RuntimeError(f"pdf_to_epub {status}: {detail}")
+            output_size = os.path.getsize(detail)
+        else:
+            content, images = main.extract_pdf(doc, img_prefix="bench")
+            output_size = len(content.encode("utf-8")) + sum(len(data) for data in images.values())
+            doc.close()
+        seconds = perf_counter() - time_start
+
+    return {"pages": page_count, "seconds": seconds, "pages_per_sec": page_count / seconds, "peak_rss": peak_rss(), "output_size": output_size}
+
+def measure(pdf_path, target, repeat):
+    """Best of repeat runs, each in a new process."""
+    runs = []
+    context = multiprocessing.get_context("spawn")
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            runs.append(executor.submit(run_case, pdf_path, target).result())
+    best = max(runs, key=lambda run: run["pages_per_sec"])
+    peaks = [run["peak_rss"] for run in runs if run["peak_rss"] is not None]
+    best["peak_rss"] = max(peaks) if peaks else None
+    best["runs"] = [round(run["seconds"], 4) for run in runs]
+    return best
+
+def compare(results, baseline, threshold):
+    """Returns a list of (case, metric, baseline value, new value) that got worse by more than threshold."""
+    regressions = []
+    for case, result in results["cases"].items():
+        base = baseline["cases"].get(case)
+        if base is None:
+            continue
+        if result["pages_per_sec"] < base["pages_per_sec"] * (1 - threshold):
+            regressions.append((case, "pages/sec", base["pages_per_sec"], result["pages_per_sec"]))
+        if result["peak_rss"] and base["peak_rss"] and result["peak_rss"] > base["peak_rss"] * (1 + threshold):
+            regressions.append((case, "peak RSS", base["peak_rss"], result["peak_rss"]))
+        if result["output_size"] > base["output_size"] * (1 + threshold):
+            regressions.append((case, "output size", base["output_size"], result["output_size"]))
+    return regressions
+
+def print_results(results, baseline=None):
+    table = Table(title="Benchmark", title_justify="left")
+    table.add_column("Case")
+    table.add_column("Pages", justify="right")
+    table.add_column("Pages/sec", justify="right")
+    table.add_column("Peak RSS", justify="right")
+    table.add_column("Output", justify="right")
+    if baseline:
+        table.add_column("vs baseline", justify="right")
+
+    for case, result in results["cases"].items():
+        row = [case, str(result["pages"]), f"{result['pages_per_sec']:.1f}",
+               format_size(result["peak_rss"]) if result["peak_rss"] else "-", format_size(result["output_size"])]
+        if baseline:
+            base = baseline["cases"].get(case)
+            if base:
+                change = result["pages_per_sec"] / base["pages_per_sec"] - 1
+                color = "green" if change >= 0 else "yellow"
+                row.append(f"[{color}]{change:+.1%}[/{color}]")
+            else:
+                row.append("new")
+        table.add_row(*row)
+
+    debug_print("spacing", "")
+    console.print(table)
+
+@click.command()
+@click.option("--corpus-dir", default="bench_corpus", help="Folder for the generated PDFs. They are generated once and reused. Default: bench_corpus")
+@click.option("--output", "-o", help="Save the results to this JSON file")
+@click.option("--baseline", help="Compare against the results in this JSON file")
+@click.option("--threshold", default=0.1, help="Fail when pages/sec drops, or peak RSS or output size grows, by more than this fraction of the baseline. Default: 0.1")
+@click.option("--case", "cases", multiple=True, type=click.Choice(list(CORPORA)), help="Only run these corpora. Can be used more than once. Default: all")
+@click.option("--target", "targets", multiple=True, type=click.Choice(TARGETS), help="Only run these functions. Can be used more than once. Default: all")
+@click.option("--repeat", default=3, help="Runs per case, the fastest one is reported. Default: 3")
+def benchmark(corpus_dir, output, baseline, threshold, cases, targets, repeat):
+    if repeat < 1:
+        debug_print("error", f"--repeat must be at least 1. Got {repeat}")
+        return
+    baseline_results = None
+    if baseline:
+        with open(baseline, encoding="utf-8") as f:
+            baseline_results = json.load(f)
+        if baseline_results.get("corpus_version") != CORPUS_VERSION:
+            debug_print("warning", f"Baseline was made with corpus version {baseline_results.get('corpus_version')}, this is version {CORPUS_VERSION}")
+
+    results = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "corpus_version": CORPUS_VERSION,
+        "python": platform.python_version(),
+        "pymupdf": pymupdf.VersionBind,
+        "platform": platform.platform(),
+        "cases": {},
+    }
+    for name in cases or CORPORA:
+        pdf_path = get_corpus(corpus_dir, name)
+        for target in targets or TARGETS:
+            debug_print("info", f"Running {name}/{target}...")
+            results["cases"][f"{name}/{target}"] = measure(pdf_path, target, repeat)
+
+    print_results(results, baseline_results)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        debug_print("info", f"Saved results to {output}")
+
+    if baseline_results:
+        regressions = compare(results, baseline_results, threshold)
+        for case, metric, before, after in regressions:
+            debug_print("error", f"{case}: {metric} regressed from {before:,.1f} to {after:,.1f}")
+        if regressions:
+            sys.exit(1)
+        debug_print("success", f"No regressions above {threshold:.0%}")
+
+if __name__ == "__main__":
+    benchmark()
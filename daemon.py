@@ -0,0 +1,165 @@
+import os
+import json
+import signal
+import threading
+import socketserver
+import collections
+from time import perf_counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import click
+import main
+from main import Converter, Settings, debug_print, prune_cache, HEADER_THRESHOLD_HELP
+
+# Keeps warm converter workers running and takes jobs over local HTTP, so every PDF doesn't pay for
+# starting python and importing pymupdf, ebooklib and rich again.
+#   python daemon.py --jobs 4                      (http://127.0.0.1:8765)
+#   python daemon.py --socket /tmp/pdf2epub.sock
+#
+#   POST /convert  {"input": "/books/a.pdf", "output": "/epubs", "img_prefix": "", "author": null}
+#     -> {"pdf", "status", "detail", "time", "queued", "total"}
+#        status is converted, skipped or failed. time is the conversion itself, queued is the time spent waiting for a worker.
+#   GET /status    -> {"workers", "running", "converted", "skipped", "failed", "uptime"}
+#
+#   curl --unix-socket /tmp/pdf2epub.sock -d '{"input": "/books/a.pdf", "output": "/epubs"}' http://localhost/convert
+# Paths are resolved by the daemon, so relative paths are relative to the folder it was started in.
+
+PRUNE_EVERY = 100 # jobs between page cache prunes
+
+
+class Daemon:
+    """Runs the jobs of all request threads on one Converter and counts the results."""
+
+    def __init__(self, converter):
+        self.converter = converter
+        self.lock = threading.Lock()
+        self.running = 0
+        self.finished = 0
+        self.counts = collections.Counter()
+        self.time_start = perf_counter()
+
+    def convert(self, pdf_path, output, img_prefix="", author=None):
+        with self.lock:
+            self.running += 1
+        time_start = perf_counter()
+        try:
+            result = self.converter.convert(pdf_path, output, img_prefix, author)
+        finally:
+            with self.lock:
+                self.running -= 1
+        result["total"] = perf_counter() - time_start
+        result["queued"] = max(0, result["total"] - result["time"])
+
+        with self.lock:
+            self.counts[result["status"]] += 1
+            self.finished += 1
+            should_prune = self.finished % PRUNE_EVERY == 0
+        debug_print("info", f"{result['status']:<9} {pdf_path} in {result['total']:.3f}s ({result['queued']:.3f}s queued)")
+        if should_prune:
+            self.prune()
+        return result
+
+    def prune(self):
+        settings = self.converter.settings
+        if settings.cache_dir:
+            prune_cache(settings.cache_dir, settings.cache_max_size)
+
+    def status(self):
+        with self.lock:
+            return {"workers": self.converter.jobs, "running": self.running, "converted": self.counts["converted"],
+                    "skipped": self.counts["skipped"], "failed": self.counts["failed"], "uptime": perf_counter() - self.time_start}
+
+class ConvertHandler(BaseHTTPRequestHandler):
+    server_version = "pdf2epub"
+
+    def do_GET(self):
+        if self.path != "/status":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        self.send_json(200, self.server.daemon.status())
+
+    def do_POST(self):
+        if self.path != "/convert":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            pdf_path = os.path.abspath(job["input"])
+            output = os.path.abspath(job["output"])
+            img_prefix = job.get("img_prefix") or ""
+            author = job.get("author")
+            os.makedirs(output, exist_ok=True)
+        except (ValueError, KeyError, TypeError, AttributeError, OSError) as e:
+            return self.send_json(400, {"error": f"Bad job: {type(e).__name__}: {e}"})
+        self.send_json(200, self.server.daemon.convert(pdf_path, output, img_prefix, author))
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the default one prints the client address, which unix sockets don't have
+        debug_print("debug", format % args)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def stop_daemon(signum, frame):
+    raise KeyboardInterrupt
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="Address to listen on. Default: 127.0.0.1")
+@click.option("--port", default=8765, help="Port to listen on. Default: 8765")
+@click.option("--socket", "socket_path", help="Listen on this unix socket instead of --host/--port")
+@click.option("--jobs", "-j", default=2, help="Number of warm worker processes, i.e. PDFs converted at the same time. Default: 2")
+@click.option("--header-threshold", default=60, help=HEADER_THRESHOLD_HELP)
+@click.option("--img-threshold", default=0.7, help="Only extract images from this top portion of each page (0.0-1.0). Default: 0.7")
+@click.option("--save-images", is_flag=True, help="Save extracted images next to the EPUB")
+@click.option("--reencode-images", is_flag=True, help="Decode and re-encode every image as PNG instead of keeping the original JPEG/PNG/GIF data")
+@click.option("--jpeg-quality", type=click.IntRange(1, 100), help="Recompress images without transparency as JPEG with this quality (1-100)")
+@click.option("--grayscale", is_flag=True, help="Convert images to grayscale")
+@click.option("--if-exists", type=click.Choice(["overwrite", "skip", "rename"]), default="skip", help="What to do when the output EPUB already exists. Default: skip")
+@click.option("--cache-dir", help="Folder for the page cache and the manifest of converted EPUBs. Default: ~/.cache/pdf2epub")
+@click.option("--no-cache", is_flag=True, help="Don't use the page cache, and convert PDFs even if their EPUB is up to date")
+@click.option("--debug", is_flag=True, help="Log every request")
+def daemon(host, port, socket_path, jobs, header_threshold, img_threshold, save_images, reencode_images, jpeg_quality, grayscale, if_exists, cache_dir, no_cache, debug):
+    main.DEBUG_MODE = debug
+    try:
+        settings = Settings(
+            header_threshold=header_threshold, img_threshold=img_threshold, save_images=save_images, reencode_images=reencode_images,
+            jpeg_quality=jpeg_quality, grayscale=grayscale, if_exists=if_exists,
+            cache_dir=None if no_cache else os.path.normpath(cache_dir if cache_dir else main.DEFAULT_CACHE_DIR), debug=debug,
+        )
+        converter = Converter(settings, jobs)
+    except ValueError as e:
+        debug_print("error", str(e))
+        return
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path) # left over from a daemon that didn't shut down cleanly
+        server = UnixHTTPServer(socket_path, ConvertHandler)
+        address = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), ConvertHandler)
+        address = f"http://{host}:{port}"
+    server.daemon = Daemon(converter)
+
+    converter.warm_up()
+    # stop the same way on SIGTERM as on ctrl+c. set after the workers started so they don't inherit it
+    signal.signal(signal.SIGTERM, stop_daemon)
+    debug_print("success", f"Listening on {address} with {jobs} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        debug_print("info", "Shutting down...")
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+        converter.close()
+        server.daemon.prune()
+
+if __name__ == "__main__":
+    daemon()
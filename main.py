@@ -6,9 +6,26 @@ from rich.console import Console
 from rich.rule import Rule
 import click
 import inspect
+import hashlib
+import re
+import math
+import itertools
+import collections
+import zipfile
+import sys
+import shutil
+import random
+import mmap
 import datetime
-from time import time as curr_time
+import json
+import contextlib
+import dataclasses
+import tracemalloc
+from time import time as curr_time, perf_counter, process_time
 import pathvalidate
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from rich.table import Table
 
 HEADER_FOOTER_THRESHOLD = 60
 IGNORE_IMAGE_THRESHOLD = 0.7
@@ -17,6 +34,66 @@ DO_SAVE_IMG = False
 SHOULD_OVERWRITE = False
 SKIP_ALL_FILES = False
 RENAME_ALL_FILES = False
+PASSTHROUGH_IMAGES = True
+IMAGE_MAX_SIZE = None # (width, height)
+JPEG_QUALITY = None
+DEFAULT_JPEG_QUALITY = 85 # for JPEG images that are downscaled or made grayscale without --jpeg-quality
+GRAYSCALE_IMAGES = False
+IMAGE_JOBS = 1
+PAGE_JOBS = 1
+PIPELINE = False # write the EPUB on a background thread
+WRITE_QUEUE_SIZE = 8 # pages waiting to be written with --pipeline
+PAGE_SELECTION = None # --pages, e.g. "1-10,25"
+CHAPTER_SELECTION = None # --chapters
+MAX_VOLUME_PAGES = None
+MAX_VOLUME_SIZE = None # bytes
+MAX_CHAPTER_SIZE = 256 * 1024 # bytes of XHTML (UTF-8) per chapter file, 0 to keep chapters in one file
+PAGE_NAV = False # TOC entry for every chapter file of PDFs without a TOC
+WORKER_DOC = None # document handle reused by page workers
+WORKER_IMAGE_CACHE = None
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "pdf2epub")
+CACHE_DIR = DEFAULT_CACHE_DIR # None when --no-cache is used
+CACHE_MAX_SIZE = 1024 * 1024 * 1024
+PROFILER = None # Profiler when --profile is used
+NO_PROFILE = contextlib.nullcontext()
+CACHE_VERSION = 3 # bump when extract_page output changes, so old cache entries are not used anymore
+SCANNED_CONTENTS_MAX_SIZE = 1024 # bytes. content streams of scanned pages are a few dozen
+ANALYZE_SAMPLE_PAGES = 32 # pages of every PDF that --analyze reads
+ANALYZE_MAX_RUNS = 200 # most recent conversions --analyze calibrates with
+UNFILTERED_STREAM_RATIO = 0.2 # about how much deflate shrinks page content and raw pixels
+# --analyze estimates: base + the sum of every feature of get_pdf_stats times its weight. set from conversions of
+# the benchmark corpus and a few scans with one job and default settings, then scaled by the runs recorded on this machine
+ESTIMATE_MODEL = {
+    "time": {"base": 0.013, "pages": 0.0027, "passthrough_bytes": 1e-9, "reencode_bytes": 8.8e-8},
+    "size": {"base": 2000, "chapters": 600, "content_bytes": 0.4, "passthrough_bytes": 1.0, "reencode_bytes": 1.0},
+    "memory": {"base": 72e6, "largest_chapter_bytes": 21.6, "largest_image_pixels": 4.0},
+}
+LAYOUT_SAMPLE_PAGES = 64 # pages the header/footer index is built from
+LAYOUT_MARGIN = 0.15 # top and bottom part of the page where headers and footers are looked for
+LAYOUT_ROW_HEIGHT = 4 # blocks whose top is this close (pt) count as being at the same position
+LAYOUT_REPEAT_RATIO = 0.2 # share of the sampled pages a block has to be on to count as header or footer
+LAYOUT_POSITION_RATIO = 0.5 # same, for detached blocks whose text changes, e.g. a running header with the chapter title
+LAYOUT_MAX_HEADER_HEIGHT = 24 # pt. taller blocks are never detached
+LAYOUT_HEADER_GAP = 1.5 # detached blocks are this many times further from the text than the next row of it is from the one after
+HEADER_THRESHOLD_HELP = (
+    "Text blocks this close (pt) to the top or bottom of a page are removed. When the PDF (or its selected pages) "
+    f"has 3 to {LAYOUT_SAMPLE_PAGES} pages, only the outermost text is, and only when it repeats on another page or "
+    f"matches the rule below. Further in, up to {LAYOUT_MARGIN:.0%} of the page height, the outermost text is removed "
+    f"when it repeats on {LAYOUT_REPEAT_RATIO:.0%} of up to {LAYOUT_SAMPLE_PAGES} sampled pages, or when it is a short "
+    f"line set apart from the text at the same position on {LAYOUT_POSITION_RATIO:.0%} of them. Images in it are ignored. Default: 60"
+)
+TEXT_FLAGS = pymupdf.TEXTFLAGS_DICT & ~pymupdf.TEXT_PRESERVE_IMAGES
+IMG_SRC_PATTERN = re.compile(r'src="images/([^"]+)"')
+DIGITS_PATTERN = re.compile(r"\d+")
+PARAGRAPH_END_PATTERN = re.compile(r"</p>|/>\n") # where page content can be split
+ROMAN_NUMERAL_PATTERN = re.compile(r"[ivxlcdm]+")
+# image formats every EPUB reader has to support. anything else is re-encoded as png
+EPUB_IMAGE_TYPES = {
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+}
 
 LEVEL_COLOR = {
     "info": "white",
@@ -30,14 +107,35 @@ LEVEL_COLOR = {
 console = Console()
 
 @click.command()
-@click.option("--input", "-i", required=True, help="Input PDF file or folder path")
-@click.option("--output", "-o", required=True, help="Output directory (default to output/)")
-@click.option("--header-threshold", default=60, help="Header/footer threshold for text extraction. default is 60")
+@click.option("--input", "-i", required=True, help="Input PDF file or folder path, or - to read one PDF from stdin")
+@click.option("--output", "-o", required=True, help="Output directory (default to output/), or - to write the EPUB of a single PDF to stdout")
+@click.option("--header-threshold", default=60, help=HEADER_THRESHOLD_HELP)
 @click.option("--img-threshold", default=0.7, help="Image extraction region (0.0-1.0). Only extracts images from the top portion of each PDF page. For example, 0.7 extracts images from the top 70% of the page, ignoring the bottom 30%. Default: 0.7")
 @click.option("--img-prefix", default="", help="Image prefix. Will be used to name the extracted images")
 @click.option("--author", help="Set author for current pdf(s). Will override author detected from pdf metadata")
 @click.option("--save-images", is_flag=True, help="Save extracted images from input pdf to disk")
+@click.option("--reencode-images", is_flag=True, help="Decode and re-encode every image as PNG instead of keeping the original JPEG/PNG/GIF data")
+@click.option("--image-max-size", help="Downscale images larger than WIDTHxHEIGHT pixels, e.g. 1264x1680 for a 7 inch e-reader")
+@click.option("--jpeg-quality", type=click.IntRange(1, 100), help="Recompress images without transparency as JPEG with this quality (1-100)")
+@click.option("--grayscale", is_flag=True, help="Convert images to grayscale")
+@click.option("--image-jobs", default=1, help="Number of processes that downscale/recompress images. Default: 1")
+@click.option("--pages", help="Only convert these pages, e.g. 1-10,25,40- (1-based). Other pages are not extracted")
+@click.option("--chapters", help="Only convert these chapters, e.g. 1-3,7. Chapters are counted in TOC order, including a \"No title\" chapter for pages before the first TOC entry")
+@click.option("--max-volume-pages", type=click.IntRange(1), help="Split the book into volumes of at most this many pages, at chapter boundaries")
+@click.option("--max-volume-size", type=click.IntRange(1), help="Split the book into volumes of about this many MB, at chapter boundaries")
+@click.option("--max-chapter-size", default=256, type=click.IntRange(0), help="Split chapters into XHTML files of at most about this many KB, at page or paragraph boundaries. E-readers open and page through small files much faster. 0 keeps every chapter in one file. Default: 256")
+@click.option("--page-nav", is_flag=True, help="For PDFs without a TOC, add a TOC entry with the page numbers for every XHTML file")
 @click.option("--overwrite", is_flag=True, help="Overwrite files that already exists")
+@click.option("--if-exists", type=click.Choice(["ask", "overwrite", "skip", "rename"]), default="ask", help="What to do when the output EPUB already exists. 'ask' prompts for every file and falls back to 'skip' when --jobs is more than 1. Default: ask")
+@click.option("--jobs", "-j", default=1, help="Number of PDFs to convert in parallel. Default: 1")
+@click.option("--page-jobs", default=1, help="Number of processes that extract the pages of a single PDF in parallel. Default: 1")
+@click.option("--pipeline", is_flag=True, help="Write the EPUB and save images on a background thread while the next pages are extracted. Best together with --page-jobs and --image-jobs")
+@click.option("--cache-dir", help="Folder for the page cache and the manifest of converted EPUBs. Default: ~/.cache/pdf2epub")
+@click.option("--cache-size", default=1024, help="Maximum size of the page cache in MB. The oldest entries are removed after every run. Default: 1024")
+@click.option("--no-cache", is_flag=True, help="Don't read or write the page cache, and convert PDFs even if their EPUB is up to date")
+@click.option("--profile", help="Save wall time, CPU time and allocated bytes of every stage, per document, chapter and page, to this JSON file. Runs everything in one process and traces Python allocations, which makes the conversion slower")
+@click.option("--analyze", is_flag=True, help="Don't convert, only estimate the conversion time, EPUB size and peak memory of every PDF from its page count, TOC and image sizes. Use with --jobs to analyze a large library faster")
+@click.option("--recursive", "-r", is_flag=True, help="Search the input folder recursively. Output keeps the input folder structure")
 @click.option("--debug", is_flag=True, help="Enable debug mode")
 
 # TODO edge case where the sentence is split into two pages. 
@@ -47,23 +145,73 @@ console = Console()
 #       ? check punctuation
 # TODO option to manually create TOC
 #   ? based on pages in pdf and create a toc
-# TODO add recursive function (--recursive, -r)? 
-#   just for fun. maybe add tag to preserve folder structure
 # TODO create a tool to extract text from a specific page. 
 #   make this a separate tool from the pdf2epub.
 
-def main(input, output, author, save_images, header_threshold, img_threshold, img_prefix, overwrite, debug):
-    global HEADER_FOOTER_THRESHOLD, IGNORE_IMAGE_THRESHOLD, DEBUG_MODE, DO_SAVE_IMG, SHOULD_OVERWRITE
+def main(input, output, author, save_images, header_threshold, img_threshold, img_prefix, reencode_images, image_max_size, jpeg_quality, grayscale, image_jobs, pages, chapters, max_volume_pages, max_volume_size, max_chapter_size, page_nav, overwrite, if_exists, jobs, page_jobs, pipeline, cache_dir, cache_size, no_cache, profile, analyze, recursive, debug):
+    global DEBUG_MODE, PROFILER
     DEBUG_MODE = debug
+    if output == "-": # stdout carries the EPUB, everything else goes to stderr
+        console.file = sys.stderr
     
     if img_threshold > 1 or img_threshold < 0:
         debug_print("error", f"--img-threshold must be between 0.0 and 1.0. Got {img_threshold}")
         return
-        
-    HEADER_FOOTER_THRESHOLD = header_threshold
-    IGNORE_IMAGE_THRESHOLD = img_threshold
-    DO_SAVE_IMG = save_images
-    SHOULD_OVERWRITE = overwrite
+    if jobs < 1:
+        debug_print("error", f"--jobs must be at least 1. Got {jobs}")
+        return
+    if page_jobs < 1:
+        debug_print("error", f"--page-jobs must be at least 1. Got {page_jobs}")
+        return
+    if image_jobs < 1:
+        debug_print("error", f"--image-jobs must be at least 1. Got {image_jobs}")
+        return
+    if cache_size < 0:
+        debug_print("error", f"--cache-size must be at least 0. Got {cache_size}")
+        return
+    for option, ranges in (("--pages", pages), ("--chapters", chapters)):
+        try:
+            if ranges: parse_ranges(ranges, 0)
+        except ValueError:
+            debug_print("error", f"{option} must look like 1-10,25,40-. Got {ranges}")
+            return
+    if output == "-" and (max_volume_pages or max_volume_size):
+        debug_print("error", "Volumes are written to separate files and can't be used with --output -")
+        return
+    if image_max_size:
+        try:
+            max_width, max_height = (int(n) for n in image_max_size.lower().split("x"))
+            if max_width < 1 or max_height < 1: raise ValueError
+        except ValueError:
+            debug_print("error", f"--image-max-size must look like WIDTHxHEIGHT, e.g. 1264x1680. Got {image_max_size}")
+            return
+        image_max_size = (max_width, max_height)
+
+    if profile:
+        try:
+            pathvalidate.validate_filepath(profile, platform="auto")
+        except pathvalidate.ValidationError as v_error:
+            debug_print("error", f"--profile argument is not a valid file path: {v_error}")
+            return
+        if max(jobs, page_jobs, image_jobs) > 1 or pipeline:
+            debug_print("warning", "--profile only measures work done in this thread. --jobs, --page-jobs and --image-jobs are set to 1 and --pipeline is turned off.")
+            jobs = page_jobs = image_jobs = 1
+            pipeline = False
+        PROFILER = Profiler()
+    if overwrite: if_exists = "overwrite"
+    if if_exists == "ask" and jobs > 1:
+        debug_print("warning", "Cannot ask before overwriting files when --jobs is more than 1. Existing files will be skipped.")
+        if_exists = "skip"
+
+    settings = Settings(
+        header_threshold=header_threshold, img_threshold=img_threshold, save_images=save_images, reencode_images=reencode_images,
+        image_max_size=image_max_size, jpeg_quality=jpeg_quality, grayscale=grayscale, image_jobs=image_jobs, page_jobs=page_jobs,
+        pipeline=pipeline, if_exists=if_exists, cache_dir=None if no_cache else os.path.normpath(cache_dir if cache_dir else DEFAULT_CACHE_DIR),
+        cache_max_size=cache_size * 1024 * 1024, pages=pages, chapters=chapters, max_volume_pages=max_volume_pages,
+        max_volume_size=max_volume_size * 1024 * 1024 if max_volume_size else None, max_chapter_size=max_chapter_size * 1024,
+        page_nav=page_nav, debug=debug,
+    )
+    globals().update(settings.to_globals())
     
     try:
         if img_prefix: pathvalidate.validate_filename(img_prefix, platform="auto")
@@ -78,38 +226,254 @@ def main(input, output, author, save_images, header_threshold, img_threshold, im
         return
     
     time_start = curr_time()
-    os.makedirs(output, exist_ok=True)
+    if output != "-" and not analyze:
+        os.makedirs(output, exist_ok=True)
     input = os.path.normpath(input)
     output = os.path.normpath(output)
     if SHOULD_OVERWRITE: debug_print("warning", "Force overwrite turned on.")
     debug_print("debug", f"Input  : {input}")
     debug_print("debug", f"Output : {output}")
-    pdf_counter = 0
+    debug_print("debug", f"Cache  : {CACHE_DIR}")
 
-    if os.path.isfile(input):
-        if input.lower().endswith(".pdf"):
-            pdf_to_epub(input, output, img_prefix=img_prefix, author=author)
-            pdf_counter += 1
+    if input == "-":
+        pdf_paths = ["-"]
+    elif os.path.isfile(input):
+        pdf_paths = [input] if input.lower().endswith(".pdf") else []
     elif os.path.isdir(input):
-        for filename in os.listdir(input):
-            if filename.lower().endswith('.pdf'):
-                pdf_counter += 1
-                pdf_path = os.path.join(input, filename)
-                pdf_to_epub(pdf_path, output, img_prefix=f"{img_prefix}_{pdf_counter}" if img_prefix else "", author=author)
+        pdf_paths = collect_pdfs(input, recursive)
     else:
         debug_print("error", f"Error: {input} is not a valid file or directory")
         return
     
-    if pdf_counter == 0:
+    if len(pdf_paths) == 0:
         debug_print("error", f"Error: {input} is not or has no PDF.")
         return
+    if analyze:
+        if input == "-":
+            debug_print("error", "Error: --analyze reads PDF files, not stdin.")
+            return
+        analyze_pdfs(pdf_paths, output, jobs)
+        return
+    if output == "-" and len(pdf_paths) > 1:
+        debug_print("error", f"Error: --output - writes a single EPUB to stdout, but {input} has {len(pdf_paths)} PDFs.")
+        return
+
+    conversions = [] # (pdf_path, output_dir, img_prefix)
+    for pdf_counter, pdf_path in enumerate(pdf_paths, start=1):
+        pdf_output = output
+        if os.path.isdir(input) and output != "-":
+            pdf_output = os.path.normpath(os.path.join(output, os.path.relpath(os.path.dirname(pdf_path), input)))
+            os.makedirs(pdf_output, exist_ok=True)
+        pdf_img_prefix = img_prefix
+        if img_prefix and os.path.isdir(input):
+            pdf_img_prefix = f"{img_prefix}_{pdf_counter}"
+        conversions.append((pdf_path, pdf_output, pdf_img_prefix))
+
+    if jobs > 1 and len(conversions) > 1:
+        results = convert_parallel(conversions, settings, jobs, author)
+        print_summary(results)
+    else:
+        for pdf_path, pdf_output, pdf_img_prefix in conversions:
+            if PROFILER: PROFILER.start_document(pdf_path)
+            status, detail = pdf_to_epub(sys.stdin.buffer if pdf_path == "-" else pdf_path, sys.stdout.buffer if pdf_output == "-" else pdf_output,
+                                         img_prefix=pdf_img_prefix, author=author)
+            if PROFILER: PROFILER.end_document(status)
+    if CACHE_DIR:
+        prune_cache(CACHE_DIR, CACHE_MAX_SIZE)
+    if PROFILER:
+        PROFILER.save(profile)
     
     time_end = curr_time()
     debug_print("spacing", "")
-    debug_print("success", f"Finished converting {pdf_counter} PDFs in {round((time_end - time_start), 3)} seconds")
+    debug_print("success", f"Finished converting {len(pdf_paths)} PDFs in {round((time_end - time_start), 3)} seconds")
+
+def collect_pdfs(input_dir, recursive=False):
+    if not recursive:
+        return [os.path.join(input_dir, filename) for filename in os.listdir(input_dir)
+                if filename.lower().endswith(".pdf") and os.path.isfile(os.path.join(input_dir, filename))]
+
+    pdf_paths = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.lower().endswith(".pdf"):
+                pdf_paths.append(os.path.join(root, filename))
+    return pdf_paths
+
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    """Everything that changes how a PDF is converted. main() builds one from the command line options,
+    Converter takes one directly. Same defaults as the command line, except that existing EPUBs are skipped instead of asking."""
+    header_threshold: int = 60
+    img_threshold: float = 0.7
+    save_images: bool = False
+    reencode_images: bool = False
+    image_max_size: tuple | None = None # (width, height)
+    jpeg_quality: int | None = None
+    grayscale: bool = False
+    image_jobs: int = 1
+    page_jobs: int = 1
+    pipeline: bool = False
+    if_exists: str = "skip" # ask, overwrite, skip or rename
+    cache_dir: str | None = DEFAULT_CACHE_DIR # None turns off the page cache
+    cache_max_size: int = 1024 * 1024 * 1024
+    pages: str | None = None # 1-based ranges, e.g. "1-10,25,40-"
+    chapters: str | None = None
+    max_volume_pages: int | None = None
+    max_volume_size: int | None = None # bytes
+    max_chapter_size: int = 256 * 1024 # bytes, 0 keeps chapters in one file
+    page_nav: bool = False
+    debug: bool = False
+
+    def __post_init__(self):
+        if not 0 <= self.img_threshold <= 1:
+            raise ValueError(f"img_threshold must be between 0.0 and 1.0. Got {self.img_threshold}")
+        if self.image_jobs < 1 or self.page_jobs < 1:
+            raise ValueError(f"image_jobs and page_jobs must be at least 1. Got {self.image_jobs} and {self.page_jobs}")
+        if self.jpeg_quality is not None and not 1 <= self.jpeg_quality <= 100:
+            raise ValueError(f"jpeg_quality must be between 1 and 100. Got {self.jpeg_quality}")
+        for ranges in (self.pages, self.chapters):
+            if ranges: parse_ranges(ranges, 0)
+        if self.max_chapter_size < 0:
+            raise ValueError(f"max_chapter_size must be at least 0. Got {self.max_chapter_size}")
+        if self.if_exists not in ("ask", "overwrite", "skip", "rename"):
+            raise ValueError(f"if_exists must be one of ask, overwrite, skip or rename. Got {self.if_exists}")
+
+    def to_globals(self):
+        """The module globals that pdf_to_epub and the functions below it read their settings from."""
+        return {
+            "HEADER_FOOTER_THRESHOLD": self.header_threshold,
+            "IGNORE_IMAGE_THRESHOLD": self.img_threshold,
+            "DO_SAVE_IMG": self.save_images,
+            "SHOULD_OVERWRITE": self.if_exists == "overwrite",
+            "SKIP_ALL_FILES": self.if_exists == "skip",
+            "RENAME_ALL_FILES": self.if_exists == "rename",
+            "PASSTHROUGH_IMAGES": not self.reencode_images,
+            "IMAGE_MAX_SIZE": tuple(self.image_max_size) if self.image_max_size else None,
+            "JPEG_QUALITY": self.jpeg_quality,
+            "GRAYSCALE_IMAGES": self.grayscale,
+            "IMAGE_JOBS": self.image_jobs,
+            "PAGE_JOBS": self.page_jobs,
+            "PIPELINE": self.pipeline,
+            "CACHE_DIR": self.cache_dir,
+            "CACHE_MAX_SIZE": self.cache_max_size,
+            "PAGE_SELECTION": self.pages,
+            "CHAPTER_SELECTION": self.chapters,
+            "MAX_VOLUME_PAGES": self.max_volume_pages,
+            "MAX_VOLUME_SIZE": self.max_volume_size,
+            "MAX_CHAPTER_SIZE": self.max_chapter_size,
+            "PAGE_NAV": self.page_nav,
+            "DEBUG_MODE": self.debug,
+        }
+
+def get_worker_settings():
+    # settings of this process, for the page and image workers it starts. the names come from Settings, so none can be missed
+    return {name: globals()[name] for name in Settings().to_globals()}
+
+def init_worker(settings):
+    # workers may be spawned instead of forked, so the settings from main() have to be copied over.
+    # worker output would interleave, the main process prints a summary instead.
+    globals().update(settings)
+    console.quiet = True
+
+def convert_worker(pdf_path, output, img_prefix, author):
+    time_start = curr_time()
+    try:
+        os.makedirs(output, exist_ok=True)
+        status, detail = pdf_to_epub(pdf_path, output, img_prefix=img_prefix, author=author)
+    except Exception as e:
+        status, detail = "failed", f"{type(e).__name__}: {e}"
+    return {"pdf": pdf_path, "status": status, "detail": detail, "time": curr_time() - time_start}
+
+def warm_worker():
+    return os.getpid()
+
+class Converter:
+    """Converts PDFs with one Settings, for use from other programs. Can be shared between threads.
+    pdf_to_epub reads its settings from module globals, so every conversion runs in one of `jobs` worker processes
+    that got the settings when they started. Workers stay up between conversions, so imports and startup are paid once.
+
+        with Converter(Settings(if_exists="overwrite"), jobs=4) as converter:
+            result = converter.convert("book.pdf", "output")
+    """
+
+    def __init__(self, settings=None, jobs=1):
+        if jobs < 1:
+            raise ValueError(f"jobs must be at least 1. Got {jobs}")
+        self.settings = settings if settings is not None else Settings()
+        if self.settings.if_exists == "ask":
+            raise ValueError("if_exists='ask' needs a terminal, use overwrite, skip or rename")
+        self.jobs = jobs
+        self.executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(self.settings.to_globals(),))
+
+    def warm_up(self):
+        """Starts the worker processes now instead of on the first conversion."""
+        for future in [self.executor.submit(warm_worker) for _ in range(self.jobs)]:
+            future.result()
+
+    def submit(self, pdf_path, output, img_prefix="", author=None):
+        """Queues a conversion. Returns a Future of the dict returned by convert()."""
+        return self.executor.submit(convert_worker, pdf_path, output, img_prefix, author)
+
+    def convert(self, pdf_path, output, img_prefix="", author=None):
+        """Converts pdf_path into the output folder and waits for it.
+        Returns {"pdf", "status", "detail", "time"} where status is one of "converted", "skipped" or "failed"."""
+        try:
+            return self.submit(pdf_path, output, img_prefix, author).result()
+        except BrokenProcessPool as e: # worker process died
+            return {"pdf": pdf_path, "status": "failed", "detail": f"Worker process died: {e}", "time": 0}
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def convert_parallel(conversions, settings, jobs, author):
+    # largest files first so one big PDF doesn't end up running alone at the end
+    conversions = sorted(conversions, key=lambda c: os.path.getsize(c[0]), reverse=True)
+    results = []
+    debug_print("info", f"Converting {len(conversions)} PDFs with {jobs} jobs...")
+
+    with Converter(settings, jobs) as converter:
+        futures = {}
+        for pdf_path, pdf_output, pdf_img_prefix in conversions:
+            future = converter.submit(pdf_path, pdf_output, pdf_img_prefix, author)
+            futures[future] = pdf_path
+        for future in track(as_completed(futures), total=len(futures), description="[cyan]Converting PDFs...[/cyan]", console=console):
+            try:
+                results.append(future.result())
+            except Exception as e: # worker process died
+                results.append({"pdf": futures[future], "status": "failed", "detail": str(e), "time": 0})
+
+    results.sort(key=lambda r: r["pdf"])
+    return results
+
+def print_summary(results):
+    status_color = {"converted": "green", "skipped": "yellow", "failed": "bright_red"}
+    table = Table(title="Summary", title_justify="left")
+    table.add_column("PDF")
+    table.add_column("Status")
+    table.add_column("Time (s)", justify="right")
+    table.add_column("Details")
+
+    for result in results:
+        color = status_color.get(result["status"], "white")
+        table.add_row(result["pdf"], f"[{color}]{result['status']}[/{color}]", f"{result['time']:.3f}", result["detail"] or "")
+
+    debug_print("spacing", "")
+    console.print(table)
+    failed = [result for result in results if result["status"] == "failed"]
+    if failed:
+        debug_print("error", f"{len(failed)} of {len(results)} PDFs failed to convert")
 
 def debug_print(level, text, i=None):
-    global DEBUG_MODE
+    # this is called from per-page and per-block loops, disabled debug output returns before anything is formatted
+    if not DEBUG_MODE and level in ("debug", "debug_data"):
+        return
     level = level.lower()
 
     if level == "spacing":
@@ -187,67 +551,247 @@ def handle_file_overwrite(output_path):
         elif choice == "": 
             return output_path
 
-def create_epub(chapters, output_filename, title, author, cover_image=None):
-    debug_print("spacing", "")
-    debug_print("info", f"Creating EPUB {output_filename}...")
-    book = epub.EpubBook()
-    book.set_identifier("")
-    book.set_title(title)
-    debug_print("info", f"Set title to [cyan]\"{title}\"[/cyan]")
-    book.set_language("en")
-    book.add_author(author)
-    debug_print("info", f"Set author to [cyan]\"{author}\"[/cyan]") if author else debug_print("warning", "Author not detected")
-
-    if cover_image[0] and cover_image[1]:
-        debug_print("debug", f"Adding cover image: {cover_image[0]}")
-        book.set_cover(cover_image[0], cover_image[1])
-    
-    epub_chapters = []
-    
-    for i, (chapter_title, content, images) in enumerate(chapters):
-        chapter = epub.EpubHtml(title=chapter_title, file_name=f'chapter_{i}.xhtml', lang='en')
+class EpubStreamWriter(epub.EpubWriter):
+    """Writes chapters and images into the EPUB zip as soon as they are added, so they don't have to be kept in memory.
+    The OPF, NCX and nav only need titles and file names and are written by close().
+    Files are written to <name>.part and only renamed by close(), so an interrupted run never leaves an EPUB behind that looks finished."""
+    # already compressed formats are stored as is, deflating them again only costs time
+    STORED_SIGNATURES = (b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"\x00\x00\x00\x0cjP  ")
+
+    def __init__(self, output, title, author):
+        """output is a file name or a binary stream, e.g. sys.stdout.buffer. Streams don't have to be seekable."""
+        self.to_file = is_path(output)
+        output_filename = output if self.to_file else getattr(output, "name", "stream")
+        debug_print("spacing", "")
+        debug_print("info", f"Creating EPUB {output_filename}...")
+        book = epub.EpubBook()
+        book.set_identifier("")
+        book.set_title(title)
+        debug_print("info", f"Set title to [cyan]\"{title}\"[/cyan]")
+        book.set_language("en")
+        book.add_author(author)
+        debug_print("info", f"Set author to [cyan]\"{author}\"[/cyan]") if author else debug_print("warning", "Author not detected")
+        # the page list is built by re-reading every chapter, which is gone by then. there are no page markers in it anyway
+        super().__init__(output_filename, book, {"epub3_pages": False})
+
+        self.chapters = [] # first file of every chapter, for the TOC
+        self.spine = [] # every chapter file
+        self.has_cover = False
+        self.cover_name = None
+        self.written_items = set()
+        self.size = 0 # compressed bytes written so far
+        self.part_name = f"{output_filename}.part" if self.to_file else None
+        self.out = zipfile.ZipFile(self.part_name if self.to_file else output, "w", zipfile.ZIP_DEFLATED, compresslevel=self.options["compresslevel"])
+        self.out.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self._write_container()
+
+    def _write_item(self, item, content=None):
+        content = item.get_content() if content is None else content
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        compress_type = zipfile.ZIP_STORED if content.startswith(self.STORED_SIGNATURES) else zipfile.ZIP_DEFLATED
+        file_name = f"{self.book.FOLDER_NAME}/{item.file_name}" if item.manifest else item.file_name
+        self.out.writestr(file_name, content, compress_type=compress_type)
+        self.size += self.out.filelist[-1].compress_size
+        self.written_items.add(item.id)
+        item.content = b"" # the manifest only needs the file name from now on
+
+    def add_chapter(self, title, content, part=0):
+        """Adds a chapter file. Parts after the first (part > 0) continue the last chapter, they are only in the spine."""
+        if part:
+            file_name = f"chapter_{len(self.chapters) - 1}_{part}.xhtml"
+        else:
+            file_name = f"chapter_{len(self.chapters)}.xhtml"
+        chapter = epub.EpubHtml(uid=os.path.splitext(file_name)[0], title=title, file_name=file_name, lang="en")
         chapter.content = content
-        epub_chapters.append(chapter)
-        book.add_item(chapter)
-        
-        # Add images to the book
+        self.book.add_item(chapter)
+        self._write_item(chapter)
+        if not part:
+            self.chapters.append(chapter)
+        self.spine.append(chapter)
+
+    def add_image(self, img_name, img_data):
+        if img_name == self.cover_name:
+            return
+        media_type = EPUB_IMAGE_TYPES.get(os.path.splitext(img_name)[1][1:].lower(), "application/octet-stream")
+        img_item = epub.EpubImage(uid=img_name, file_name=f"images/{img_name}", media_type=media_type, content=img_data)
+        self.book.add_item(img_item)
+        self._write_item(img_item)
+
+    def set_cover(self, img_name, img_data):
+        debug_print("debug", f"Adding cover image: {img_name}")
+        # the cover is the same file the chapters point to, add_image() skips it
+        self.cover_name = img_name
+        self.book.set_cover(f"images/{img_name}", img_data)
+        self._write_item(self.book.get_item_with_id("cover-img"))
+        self._write_item(self.book.get_item_with_id("cover"))
+        self.has_cover = True
+
+    def close(self):
+        if not self.chapters:
+            self.add_chapter("Content", "<p>No content could be extracted from this PDF.</p>")
+
+        # Define the book spine and TOC
+        self.book.toc = self.chapters
+        self.book.spine = ["nav"] + self.spine
+        self.book.add_item(epub.EpubNcx())
+        self.book.add_item(epub.EpubNav())
+
+        with console.status(f"Writing epub file..."):
+            try:
+                self._write_opf()
+                for item in self.book.get_items():
+                    if item.id in self.written_items:
+                        continue
+                    if isinstance(item, epub.EpubNcx):
+                        self._write_item(item, self._get_ncx())
+                    elif isinstance(item, epub.EpubNav):
+                        self._write_item(item, self._get_nav(item))
+                    else:
+                        self._write_item(item)
+                self.out.close()
+                if self.to_file:
+                    os.replace(self.part_name, self.file_name)
+                debug_print("success", f"EPUB file '{self.file_name}' created successfully.")
+                debug_print("spacing", "")
+                return True
+            except Exception as e:
+                debug_print("error", f"Failed to write epub {self.file_name}:\n{e}")
+                self.abort()
+                return False
+
+    def abort(self):
+        self.out.close()
+        # whatever was written to a stream can't be taken back
+        if self.to_file and os.path.exists(self.part_name):
+            os.remove(self.part_name)
+
+class ChapterParts:
+    """Collects the pages of one chapter and splits them into parts of at most MAX_CHAPTER_SIZE bytes of UTF-8.
+    E-readers parse and paginate a whole XHTML file when it is opened, so a book without a TOC in one file opens slowly.
+    Parts end at page boundaries, pages that are too big on their own are split after a paragraph or image."""
+
+    def __init__(self, max_size=None):
+        self.max_size = MAX_CHAPTER_SIZE if max_size is None else max_size
+        self.content = []
+        self.size = 0
+        self.pages = None # (first, last) page index of the current part
+        self.count = 0 # parts made so far
+
+    def add(self, content, page=None):
+        """Adds the content of a page. Yields (content, first page, last page) for every part that is full."""
+        pieces = [(content, len(content.encode("utf-8")))]
+        if self.max_size and pieces[0][1] > self.max_size:
+            ends = [match.end() for match in PARAGRAPH_END_PATTERN.finditer(content)]
+            pieces = [(content[start:end], len(content[start:end].encode("utf-8")))
+                      for start, end in zip([0] + ends, ends + [len(content)]) if start < end]
+        for piece, size in pieces:
+            if self.max_size and self.content and self.size + size > self.max_size:
+                yield self.flush()
+            self.content.append(piece)
+            self.size += size
+            self.pages = (self.pages[0] if self.pages else page, page)
+
+    def close(self):
+        """Yields the last part. Every chapter has at least one, even without content."""
+        if self.content or not self.count:
+            yield self.flush()
+
+    def flush(self):
+        first_page, last_page = self.pages or (None, None)
+        part = ("".join(self.content), first_page, last_page)
+        self.content = []
+        self.size = 0
+        self.pages = None
+        self.count += 1
+        return part
+
+class WriteQueue:
+    """Runs the EPUB writes and image saves of one conversion in the order they were added.
+    With --pipeline they run on a background thread while the next pages are extracted. zlib and file writes
+    release the GIL, so they overlap with extraction instead of adding to it. At most WRITE_QUEUE_SIZE pages wait,
+    so a slow disk holds extraction back instead of filling up memory."""
+
+    def __init__(self, threaded=False):
+        # one thread, so writes keep their order. nothing on it touches pymupdf, which isn't thread safe
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="epub_writer") if threaded else None
+        self.pending = collections.deque()
+
+    def put(self, function, *args):
+        """Runs function(*args), now or on the writer thread. Returns a Future of its result.
+        Errors of earlier writes are raised here or by join()."""
+        if self.executor is None:
+            future = Future()
+            future.set_result(function(*args))
+            return future
+        future = self.executor.submit(function, *args)
+        self.pending.append(future)
+        while len(self.pending) > WRITE_QUEUE_SIZE:
+            self.pending.popleft().result()
+        return future
+
+    def join(self):
+        """Waits until everything put so far is written, e.g. before reading writer.size."""
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self, cancel=False):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=cancel)
+        if not cancel:
+            self.join()
+
+def write_page_images(writer, images, img_output_dir=None):
+    """Adds the images of one page to the EPUB and saves them to img_output_dir. Returns how many were saved."""
+    with profile_stage("epub_write"):
         for img_name, img_data in images.items():
-            img_item = epub.EpubItem(uid=img_name, file_name=f'images/{img_name}', media_type='image/jpeg', content=img_data)
-            book.add_item(img_item)
-
-    if not epub_chapters:
-        dummy_chapter = epub.EpubHtml(title="Content", file_name='chapter_0.xhtml', lang='en')
-        dummy_chapter.content = "<p>No content could be extracted from this PDF.</p>"
-        epub_chapters.append(dummy_chapter)
-
-    # Define the book spine and TOC
-    book.toc = epub_chapters
-    book.spine = ['nav'] + epub_chapters
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-    
-    with console.status(f"Writing epub file..."):
-        try:
-            epub.write_epub(output_filename, book)
-            debug_print("success", f"EPUB file '{output_filename}' created successfully.")
-            debug_print("spacing", "")
-        except Exception as e:
-            debug_print("error", f"Failed to write epub {output_filename}:\n{e}")
+            writer.add_image(img_name, img_data)
+    if not img_output_dir:
+        return 0
+    with profile_stage("image_save"):
+        return handle_save_images(images, img_output_dir)
 
-def handle_extract_with_font(span):
+def get_span_style(span):
     span_font = span["font"].lower()
-    if "italic" in span_font and "bold" in span_font:
-        return f"<b><i>{span['text']}</i></b>"
-    elif "italic" in span_font:
-        return f"<i>{span['text']}</i>"
-    elif "bold" in span_font:
-        return f"<b>{span['text']}</b>"
+    return ("bold" in span_font, "italic" in span_font)
+
+def handle_extract_with_font(text, style):
+    is_bold, is_italic = style
+    if is_bold and is_italic:
+        return f"<b><i>{text}</i></b>"
+    elif is_italic:
+        return f"<i>{text}</i>"
+    elif is_bold:
+        return f"<b>{text}</b>"
     else: 
-        return span["text"]
+        return text
+
+def spans_to_html(spans):
+    """Joins spans into HTML with a single <b>/<i> tag around every run of spans that share the same style."""
+    parts = []
+    run = []
+    run_style = None
+    for span in spans:
+        # whitespace looks the same in any style, so it doesn't break up a run
+        span_style = run_style if run_style is not None and not span["text"].strip() else get_span_style(span)
+        if span_style != run_style and run:
+            parts.append(handle_extract_with_font("".join(run), run_style))
+            run = []
+        run_style = span_style
+        run.append(span["text"])
+
+    if run:
+        parts.append(handle_extract_with_font("".join(run), run_style))
+    return "".join(parts)
 
 def in_header_footer(bbox, page_height):
     return (bbox[1] <= HEADER_FOOTER_THRESHOLD or bbox[1] >= page_height - HEADER_FOOTER_THRESHOLD)
 
+def is_ignored_image(bbox, page_rect):
+    # images in headers and the bottom part of the page (--img-threshold) are left out, unless they take the full page
+    return not takes_full_page(bbox, page_rect) and (bbox[1] > page_rect.height * IGNORE_IMAGE_THRESHOLD
+                                                     or in_header_footer(bbox, page_rect.height))
+
 def takes_full_page(bbox, page_rect):
     page_width = page_rect.width
     page_height = page_rect.height
@@ -262,7 +806,7 @@ def takes_full_page(bbox, page_rect):
     return area_ratio >= 0.7 or (width_ratio >= 0.8 and height_ratio >= 0.8)
 
 def combine_extract_text_from_lines(lines):
-    text = ""
+    paragraphs = []
     combined_spans = []
     
     for i, line in enumerate(lines):
@@ -278,24 +822,59 @@ def combine_extract_text_from_lines(lines):
             combined_spans.append({"text": " ", "font": ""})  # add space between lines
             continue
 
-        all_spans = combined_spans + line["spans"]
-        line_text = ""
-        for span in all_spans:
-            line_text += handle_extract_with_font(span)
-        
-        text += f"<p>{line_text}</p>"
+        combined_spans.extend(line["spans"])
+        paragraphs.append(f"<p>{spans_to_html(combined_spans)}</p>")
         combined_spans = []
     
+    text = "".join(paragraphs)
     return text if text.strip() else "<p> </p>"
 
 def extract_img_from_xref(doc, xref):
+    """Returns (image data, extension). The original image stream is kept when EPUB readers can show it,
+    otherwise (CMYK, soft masks, JPX, JBIG2, ...) the image is decoded and re-encoded as png."""
     try:
+        smask = 0
+        if PASSTHROUGH_IMAGES:
+            img = doc.extract_image(xref)
+            smask = img["smask"]
+            if img["ext"] in EPUB_IMAGE_TYPES and img["colorspace"] != 4 and not smask:
+                return img["image"], img["ext"]
+        else:
+            smask_type, smask_value = doc.xref_get_key(xref, "SMask")
+            if smask_type == "xref":
+                smask = int(smask_value.split()[0])
+
         pix = pymupdf.Pixmap(doc, xref)
         if pix.n - pix.alpha > 3: # CMYK: convert to RGB first
             pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
-        return pix
+        if smask:
+            try:
+                pix = pymupdf.Pixmap(pix, pymupdf.Pixmap(doc, smask))
+            except Exception as e:
+                debug_print("debug", f"Failed to apply soft mask xref={smask} to image xref={xref}: {e}")
+        return pix.tobytes(), "png"
     except Exception as e:
         debug_print("error", f"Failed to extract image xref={xref}:\n{e}")
+        return None, None
+
+def convert_img_bytes(img_data, img_ext, colorspace=3, mask=None):
+    """Same as extract_img_from_xref, for image data that was already extracted (image blocks of page.get_text)."""
+    if PASSTHROUGH_IMAGES and img_ext in EPUB_IMAGE_TYPES and colorspace != 4 and not mask:
+        return img_data, img_ext
+
+    try:
+        pix = pymupdf.Pixmap(img_data)
+        if pix.n - pix.alpha > 3: # CMYK: convert to RGB first
+            pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
+        if mask:
+            try:
+                pix = pymupdf.Pixmap(pix, pymupdf.Pixmap(mask))
+            except Exception as e:
+                debug_print("debug", f"Failed to apply soft mask to {img_ext} image: {e}")
+        return pix.tobytes(), "png"
+    except Exception as e:
+        debug_print("error", f"Failed to convert {img_ext} image:\n{e}")
+        return None, None
 
 def sanitize_filename(filename, max_len=40):
     return pathvalidate.sanitize_filename(filename=filename, max_len=max_len)
@@ -305,9 +884,45 @@ def truncate_string(text, max_len):
         return f"{text[:max_len]}..."
     return text
 
+class ImageCache:
+    """Keeps track of the images of one document, so an image that shows up on many pages
+    (logos, page backgrounds, ornaments) is decoded once and stored under a single file name."""
+
+    def __init__(self):
+        self.xrefs = {} # key: xref, value: filename
+        self.hashes = {} # key: content hash, value: filename
+        self.renamed = {} # key: filename of a duplicate, value: filename it was merged into
+
+    def add(self, images, img_filename, img_data, xref=None):
+        """Adds the image to images unless the same image is already cached. Returns the file name to reference it by."""
+        img_hash = hashlib.sha1(img_data).hexdigest()
+        if img_hash in self.hashes:
+            img_filename = self.hashes[img_hash]
+        else:
+            self.hashes[img_hash] = img_filename
+            images[img_filename] = img_data
+        if xref:
+            self.xrefs[xref] = img_filename
+        return img_filename
+
+    def merge_page(self, content, images):
+        """Deduplicates a page that was extracted with another cache (e.g. by a page worker) against this one."""
+        unique_images = {}
+        for img_filename, img_data in images.items():
+            cached_filename = self.add(unique_images, img_filename, img_data)
+            if cached_filename != img_filename:
+                self.renamed[img_filename] = cached_filename
+
+        if self.renamed:
+            content = rename_img_src(content, self.renamed)
+        return content, unique_images
+
+def rename_img_src(content, renamed):
+    return IMG_SRC_PATTERN.sub(lambda match: f'src="images/{renamed.get(match[1], match[1])}"', content)
+
 def extract_pdf(doc: pymupdf.Document,start=0, end=None, img_prefix="", show_progress=False):
     end = doc.page_count if end == None else end
-    content = ""
+    content = []
     images = {} # key: filename, value: image data
     doc_title = doc.metadata.get("title") if doc.metadata.get("title").strip() != "" else img_prefix
     page_range = range(start, end)
@@ -316,96 +931,290 @@ def extract_pdf(doc: pymupdf.Document,start=0, end=None, img_prefix="", show_pro
     if show_progress:
         page_range = track(page_range, description=f"[cyan]Processing PDF...[/cyan]", console=console)
 
+    image_cache = ImageCache()
     for i in page_range:
-        page = doc[i]
-        page_height = page.rect.height
-        dicts = page.get_text("dict", sort=True)
-        img_count = 0
-        img_list = page.get_images()
-        get_images_count = len(img_list)
-        ignored_images = set()
-
-        for element in dicts["blocks"]:
-            if element["type"] == 0: # text block
-                # ignore text blocks in headers and footers
-                if in_header_footer(element["bbox"], page_height):
-                    continue
-                content += combine_extract_text_from_lines(element["lines"])
-            
-            elif element["type"] == 1: # image
-                img_count += 1
-                img_data = element["image"]
-                img_bbox = element["bbox"]
-                img_filename = f"{img_prefix}-page_{i+1}-image_{img_count}.png"
-
-                # ignores images in headers and bottom part of the page (use threshold)
-                if not takes_full_page(img_bbox, page.rect) and ((img_bbox[1] > page_height * IGNORE_IMAGE_THRESHOLD) 
-                                                                 or in_header_footer(img_bbox, page_height)): 
-                    debug_print("debug", f"ignored image {img_filename} bbox: {img_bbox}", i=i)
-                    ignored_images.add(img_bbox)
-                    continue
+        page_content, page_images = extract_page(doc, i, img_prefix, image_cache)
+        content.append(page_content)
+        images.update(page_images)
 
-                # if image is an xref
-                if isinstance(img_data, int):
-                    xref = img_data
-                    if xref == 0:
-                        continue
-                    
-                    pix = extract_img_from_xref(doc, xref)
-                    images[img_filename] = pix.tobytes()
-                    pix = None
-                elif isinstance(img_data, bytes): # otherwise it's the byte data
-                    images[img_filename] = img_data
-                else:
-                    debug_print("error", f"Image not recognized! Img data: \n{img_data}", i=i)
-                    continue
+    return "".join(content), images
 
-                content += f'<img src="images/{img_filename}" alt="Image {img_count} on page {i+1}" />\n'
-            else:
-                debug_print("error", f"Error: unrecognized block type {element["type"]}", i=i)
+def get_image_digests(doc, xrefs):
+    """Pixmap digests of xrefs, kept with the document so every image is decoded for this at most once,
+    however many pages draw it next to another image of the same size."""
+    digests = getattr(doc, "image_digests", None)
+    if digests is None:
+        digests = doc.image_digests = {}
+    for xref in xrefs:
+        if xref not in digests:
+            digests[xref] = pymupdf.Pixmap(doc, xref).digest
+    return digests
 
-        # check if there are any missed images
-        if img_count < get_images_count:
-            for index, img in enumerate(img_list):
-                xref = img[0]
-                # debug_print("debug_data", page.get_image_rects(xref))
-                try:
-                    image_rects = page.get_image_rects(xref)[0] # this returns (x0, y0, x1, y1)
-                except IndexError:
-                    debug_print("error", f"Image with xref {xref} in page {i+1} doesn't exist")
-                    continue
-                image_height = image_rects[3] - image_rects[1]
-                full_img_filename = f"{img_prefix}-page_{i+1}-full_{index}.png"
-                debug_print("debug", f"Processing image {full_img_filename}")
+def get_image_index(page, img_list=None):
+    """Returns an image block ({"type": 1, "bbox", "xref"}) for every image drawn on the page, without decoding or copying any of them.
+    The xref is matched through the image size. Only images of the same size as another one on the page that are kept
+    (see is_ignored_image) need digests, which decodes the images of the page.
+    xref is 0 for inline images, and for ignored images that couldn't be told apart by their size."""
+    img_list = page.get_images(full=True) if img_list is None else img_list
+    if not img_list:
+        return []
+
+    xrefs_by_size = {} # key: (width, height, bpc), value: xrefs
+    for img in img_list:
+        xrefs_by_size.setdefault((img[2], img[3], img[4]), set()).add(img[0])
+
+    image_index = []
+    hashed_infos = None
+    for n, info in enumerate(page.get_image_info()):
+        xrefs = xrefs_by_size.get((info["width"], info["height"], info["bpc"]), set())
+        xref = next(iter(xrefs)) if len(xrefs) == 1 else 0
+        if len(xrefs) > 1 and not is_ignored_image(info["bbox"], page.rect): # tell them apart by their content
+            if hashed_infos is None:
+                hashed_infos = page.get_image_info(hashes=True)
+            digests = get_image_digests(page.parent, xrefs)
+            xref = next((candidate for candidate in sorted(xrefs) if digests[candidate] == hashed_infos[n]["digest"]), 0)
+        image_index.append({"type": 1, "bbox": info["bbox"], "xref": xref})
+
+    return image_index
+
+def get_scanned_image(page, img_list=None):
+    """Returns the image block of a scanned page, i.e. one without text where a single image takes the full page,
+    and None for every other page. Only the image list and the content stream are read, which is a lot cheaper
+    than the layout analysis and get_image_info that extract_page runs otherwise."""
+    if page.rotation:
+        return None
+    img_list = page.get_images(full=True) if img_list is None else img_list
+    if len(img_list) != 1 or img_list[0][9]: # drawn from inside a form xobject
+        return None
+    xref, img_name = img_list[0][0], f"/{img_list[0][7]}".encode()
+    # checked on the compressed streams, so pages with an image and a lot of text don't get decompressed twice
+    contents_size = 0
+    for contents_xref in page.get_contents():
+        contents_size += len(page.parent.xref_stream_raw(contents_xref) or b"")
+        if contents_size > SCANNED_CONTENTS_MAX_SIZE:
+            return None
+
+    # a scanned page only draws its image: "q <matrix> cm /Im0 Do Q". text, paths, other xobjects and inline images
+    # leave operands the operators below don't take, which sends the page down the normal path
+    ctm = pymupdf.Identity
+    saved_ctms = []
+    operands = []
+    bbox = None
+    contents = page.read_contents()
+    if b"BT" in contents: # text
+        return None
+    for token in contents.split():
+        if token not in (b"q", b"Q", b"cm", b"Do"):
+            operands.append(token)
+            continue
+        if token == b"q" and not operands:
+            saved_ctms.append(ctm)
+        elif token == b"Q" and not operands and saved_ctms:
+            ctm = saved_ctms.pop()
+        elif token == b"cm" and len(operands) == 6:
+            try:
+                ctm = pymupdf.Matrix(*(float(n) for n in operands)) * ctm
+            except ValueError:
+                return None
+        elif token == b"Do" and operands == [img_name] and bbox is None:
+            bbox = pymupdf.Rect(0, 0, 1, 1) * ctm * page.transformation_matrix
+        else:
+            return None
+        operands = []
+
+    if operands or bbox is None or not takes_full_page(bbox, page.rect):
+        return None
+    return {"type": 1, "bbox": tuple(bbox), "xref": xref}
+
+def extract_inline_image(page, bbox):
+    """Image data of an inline image (one without an xref), extracted from the page region it is drawn in."""
+    blocks = page.get_text("dict", clip=bbox, flags=pymupdf.TEXTFLAGS_DICT)["blocks"]
+    img_blocks = [block for block in blocks if block["type"] == 1]
+    for block in img_blocks:
+        if pymupdf.Rect(block["bbox"]) == pymupdf.Rect(bbox):
+            return block
+    return img_blocks[0] if img_blocks else None
+
+def get_block_key(text, top):
+    """The text of a block with digits and roman numerals replaced, so page numbers and running headers
+    with page numbers in them are the same on every page, with the row it starts in."""
+    text = " ".join(text.lower().split())
+    text = "#" if ROMAN_NUMERAL_PATTERN.fullmatch(text) else DIGITS_PATTERN.sub("#", text)
+    return text, round(top / LAYOUT_ROW_HEIGHT)
+
+def get_block_text(block):
+    return " ".join("".join(span["text"] for span in line["spans"]) for line in block["lines"])
+
+def get_edge_blocks(blocks, page_height):
+    """(index, detached) of the (bbox, text) blocks in the first row of text at the top of the page and in the last row
+    at the bottom, if they are inside LAYOUT_MARGIN. Headers and footers are always the outermost text, so the first line
+    of the body is never taken for one, even when every page starts the same way.
+    Detached blocks are short and set apart from the rest of the text, the way running headers and footers are: by at least
+    their own height, and by LAYOUT_HEADER_GAP times the gap between the next two rows."""
+    if not blocks:
+        return []
+    top = min(bbox[1] for bbox, _ in blocks)
+    bottom = max(bbox[3] for bbox, _ in blocks)
+    # the bottom is looked at upside down, so both are measured from the edge inwards
+    flipped = [(page_height - bbox[3], page_height - bbox[1]) for bbox, _ in blocks]
+    edge_blocks = []
+    for n, (bbox, _) in enumerate(blocks):
+        if bbox[1] - top <= LAYOUT_ROW_HEIGHT and bbox[3] <= page_height * LAYOUT_MARGIN:
+            spans = [(other[1], other[3]) for other, _ in blocks]
+        elif bottom - bbox[3] <= LAYOUT_ROW_HEIGHT and bbox[1] >= page_height * (1 - LAYOUT_MARGIN):
+            spans = flipped
+        else:
+            continue
+        start, end = spans[n]
+        inner = sorted(span for span in spans if span[0] > start + LAYOUT_ROW_HEIGHT)
+        gap = inner[0][0] - end if inner else page_height
+        after = [span for span in inner[1:] if span[0] > inner[0][0] + LAYOUT_ROW_HEIGHT]
+        next_gap = after[0][0] - inner[0][1] if after else 0
+        height = end - start
+        edge_blocks.append((n, height <= LAYOUT_MAX_HEADER_HEIGHT and gap >= height and gap >= next_gap * LAYOUT_HEADER_GAP))
+    return edge_blocks
+
+def get_row(bbox):
+    return round(bbox[1] / LAYOUT_ROW_HEIGHT)
+
+def count_near_rows(counter):
+    """counter with every count added to the rows right above and below as well"""
+    near_counts = collections.Counter()
+    for (key, row), count in counter.items():
+        for near_row in (row - 1, row, row + 1):
+            near_counts[(key, near_row)] += count
+    return near_counts
+
+class LayoutIndex:
+    """Headers, footers and page numbers of one document: the outermost text blocks at the top and bottom of the page
+    that repeat at the same position, counted over LAYOUT_SAMPLE_PAGES of the selected pages (page_indexes, default: all).
+    Blocks further in than --header-threshold have to be on LAYOUT_REPEAT_RATIO of the sampled pages. Detached blocks
+    (see get_edge_blocks) whose text changes, like a header with the chapter title, only have to be at the same position,
+    on LAYOUT_POSITION_RATIO of the sampled pages.
+    Inside it, blocks only have to repeat twice when every page was read. With a sample, a header that changes every chapter
+    may be missed, so everything inside --header-threshold is removed, the same as for documents with too few pages to tell."""
+
+    def __init__(self, doc, page_indexes=None):
+        page_indexes = range(doc.page_count) if page_indexes is None else page_indexes
+        sampled = sorted(random.Random(len(page_indexes)).sample(page_indexes, min(len(page_indexes), LAYOUT_SAMPLE_PAGES)))
+        rows = collections.Counter() # key: (text, row), value: sampled pages it is on
+        positions = collections.Counter() # key: (at the top, row) of detached blocks, value: sampled pages one is on
+        for pno in sampled:
+            page = doc[pno]
+            blocks = [(block[:4], block[4]) for block in page.get_text("blocks", flags=TEXT_FLAGS) if block[6] == 0]
+            edge_blocks = get_edge_blocks(blocks, page.rect.height)
+            rows.update({get_block_key(blocks[n][1], blocks[n][0][1]) for n, _ in edge_blocks})
+            positions.update({(blocks[n][0][1] < page.rect.height / 2, get_row(blocks[n][0])) for n, detached in edge_blocks if detached})
+
+        self.sampled_pages = len(sampled)
+        self.complete = self.sampled_pages == len(page_indexes)
+        # same, including the rows right above and below
+        self.counts = count_near_rows(rows)
+        self.positions = count_near_rows(positions)
+        self.min_count = max(3, self.sampled_pages * LAYOUT_REPEAT_RATIO)
+        self.min_position_count = max(3, self.sampled_pages * LAYOUT_POSITION_RATIO)
+        debug_print("debug", f"layout index: {sum(count >= 2 for count in rows.values())} repeating blocks on {self.sampled_pages} pages")
+
+    def get_header_footers(self, blocks, page_height):
+        """Indexes of the text blocks (from get_text("dict")) that are headers, footers or page numbers."""
+        if self.sampled_pages < 3:
+            return {n for n, block in enumerate(blocks) if in_header_footer(block["bbox"], page_height)}
+        header_footers = set()
+        if not self.complete:
+            header_footers = {n for n, block in enumerate(blocks) if block["type"] == 0 and in_header_footer(block["bbox"], page_height)}
+        text_blocks = [(n, block["bbox"], get_block_text(block)) for n, block in enumerate(blocks) if block["type"] == 0]
+        for n, detached in get_edge_blocks([(bbox, text) for _, bbox, text in text_blocks], page_height):
+            block_index, bbox, text = text_blocks[n]
+            if block_index in header_footers:
+                continue
+            count = self.counts.get(get_block_key(text, bbox[1]), 0)
+            if count >= (2 if in_header_footer(bbox, page_height) else self.min_count):
+                header_footers.add(block_index)
+            elif detached and self.positions.get((bbox[1] < page_height / 2, get_row(bbox)), 0) >= self.min_position_count:
+                header_footers.add(block_index)
+        return header_footers
+
+def get_layout_index(doc):
+    """The LayoutIndex of doc, built on first use and kept with the document, so it is built once however the pages are extracted.
+    It is built from the pages iter_chapters selected, so pages left out by --pages or --chapters are never read."""
+    layout_index = getattr(doc, "layout_index", None)
+    if layout_index is None:
+        with profile_stage("layout_index"):
+            layout_index = doc.layout_index = LayoutIndex(doc, getattr(doc, "selected_pages", None))
+    return layout_index
+
+def extract_page(doc: pymupdf.Document, i, img_prefix="", image_cache=None):
+    image_cache = ImageCache() if image_cache is None else image_cache
+    if PROFILER: PROFILER.start_page(i)
+    page = doc[i]
+    content = []
+    images = {} # key: filename, value: image data
+    page_height = page.rect.height
+    # images are left out of the text and placed from the image index instead, so only the images we keep are decoded
+    with profile_stage("layout"):
+        img_list = page.get_images(full=True)
+        scanned_image = get_scanned_image(page, img_list)
+        if scanned_image:
+            if DEBUG_MODE: debug_print("debug", "scanned page, skipping layout analysis", i=i)
+            blocks = [scanned_image]
+        else:
+            dicts = page.get_text("dict", sort=True, flags=TEXT_FLAGS)
+            blocks = sorted(dicts["blocks"] + get_image_index(page, img_list), key=lambda b: (b["bbox"][3], b["bbox"][0]))
+    img_count = 0
+    # repeating headers, footers and page numbers are dropped before their spans are processed
+    header_footers = get_layout_index(doc).get_header_footers(blocks, page_height) if not scanned_image else ()
+
+    for n, element in enumerate(blocks):
+        if element["type"] == 0: # text block
+            if n in header_footers:
+                if DEBUG_MODE: debug_print("debug", f"removed header/footer at {element["bbox"]}", i=i)
+                continue
+            content.append(combine_extract_text_from_lines(element["lines"]))
+        
+        elif element["type"] == 1: # image
+            img_count += 1
+            xref = element["xref"]
+            img_bbox = element["bbox"]
+            img_filename = f"{img_prefix}-page_{i+1}-image_{img_count}" # extension depends on the image format
+
+            if is_ignored_image(img_bbox, page.rect):
+                if DEBUG_MODE: debug_print("debug", f"ignored image {img_filename} bbox: {img_bbox}", i=i)
+                continue
 
-                if xref == 0:
+            if xref in image_cache.xrefs:
+                img_filename = image_cache.xrefs[xref]
+            elif xref:
+                with profile_stage("image"):
+                    img_bytes, img_ext = extract_img_from_xref(doc, xref)
+                if img_bytes is None:
+                    continue
+                img_filename = image_cache.add(images, f"{img_filename}.{img_ext}", img_bytes, xref)
+            else: # inline image
+                with profile_stage("image"):
+                    img_block = extract_inline_image(page, img_bbox)
+                if img_block is None:
+                    debug_print("error", f"Inline image at {img_bbox} not found", i=i)
                     continue
-                # image thresholds
-                if (image_rects[1] > page_height * IGNORE_IMAGE_THRESHOLD) or (image_height < 5):
-                    continue 
-                # check duplicates
-                if (image_rects in ignored_images):
+                with profile_stage("image"):
+                    img_bytes, img_ext = convert_img_bytes(img_block["image"], img_block.get("ext"), img_block.get("colorspace"), img_block.get("mask"))
+                if img_bytes is None:
                     continue
+                img_filename = image_cache.add(images, f"{img_filename}.{img_ext}", img_bytes)
 
-                pix = extract_img_from_xref(doc, img[0])
-                full_img_bytes = pix.tobytes()
-                
-                debug_print("debug", f"Adding image {full_img_filename}", i=i)
-                images[full_img_filename] = full_img_bytes
-                content += f'<img src="images/{full_img_filename}" alt="Full Image {index} on page {i+1}" />\n'
+            content.append(f'<img src="images/{img_filename}" alt="Image {img_count} on page {i+1}" />\n')
+        else:
+            debug_print("error", f"Error: unrecognized block type {element["type"]}", i=i)
 
-    return content, images
+    return "".join(content), images
 
-def extract_with_toc(doc, img_prefix):
+def get_chapter_ranges(doc, img_prefix):
+    """Returns (title, start, end) page ranges for every chapter in the TOC."""
     toc = doc.get_toc()
-    chapter_list = []
-    img_prefix = sanitize_filename(img_prefix)
     
     if not toc:
         debug_print("warning", "Table of contents not found. This book will not have any TOC.")
         debug_print("spacing", "")
-        content, images = extract_pdf(doc, img_prefix=img_prefix, show_progress=True)
-        return [(img_prefix, content, images)]
+        return [(img_prefix, 0, doc.page_count)]
        
     if toc[0][2] > 1: # include the first pages that are not in the TOC
         toc.insert(0, (1, "No title", 1))
@@ -413,62 +1222,775 @@ def extract_with_toc(doc, img_prefix):
     valid_toc = [item for item in toc if item[1].strip() != ""]
     valid_toc.sort(key=lambda x: x[2]) # sort toc based on the page
     debug_print("debug_data", valid_toc)
-    for i, toc_item in enumerate(track(valid_toc, description=f"[cyan]Processing chapters...[/cyan]", console=console)):
+    chapter_ranges = []
+    for i, toc_item in enumerate(valid_toc):
         toc_lvl, toc_title, toc_page = toc_item
         toc_page -= 1  # toc is 1-based. convert to 0-based
         
-        next_toc_page = None
+        next_toc_page = doc.page_count
         if i + 1 < len(valid_toc):
             next_toc_page = valid_toc[i + 1][2] - 1
-        toc_title = toc_title.strip()
-        content, images = extract_pdf(doc, img_prefix=img_prefix, start=toc_page, end=next_toc_page)
-        chapter_list.append((toc_title, content, images))
+        chapter_ranges.append((toc_title.strip(), toc_page, next_toc_page))
 
-    return chapter_list
+    return chapter_ranges
 
-def handle_save_images(chapters, path):
-    images = {}
-    for chapter in chapters:
-        images.update(chapter[2])
+def parse_ranges(text, count):
+    """Sorted 0-based indexes for 1-based ranges like "1-10,25,40-". Numbers above count are left out. Raises ValueError."""
+    indexes = set()
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, separator, end = part.partition("-")
+        start = int(start) if start.strip() else 1
+        end = (int(end) if end.strip() else max(count, start)) if separator else start
+        if start < 1 or end < start:
+            raise ValueError(f"invalid range {part}")
+        indexes.update(range(start - 1, min(end, count)))
+    return sorted(indexes)
 
-    os.makedirs(f"{path}", exist_ok=True)
-    debug_print("debug", f"Created folder {path} to save images")
+def get_chapters(doc, img_prefix):
+    """Returns (title, page indexes) for every chapter, limited to --chapters and --pages."""
+    chapters = [(title, list(range(start, end))) for title, start, end in get_chapter_ranges(doc, img_prefix)]
+    if CHAPTER_SELECTION:
+        chapters = [chapters[n] for n in parse_ranges(CHAPTER_SELECTION, len(chapters))]
+        debug_print("info", f"Selected chapters: {", ".join(title for title, _ in chapters)}")
+    if PAGE_SELECTION:
+        selected = set(parse_ranges(PAGE_SELECTION, doc.page_count))
+        chapters = [(title, [i for i in pages if i in selected]) for title, pages in chapters]
+        chapters = [(title, pages) for title, pages in chapters if pages]
+    return chapters
+
+def iter_chapters(doc, img_prefix, pdf_hash=None, chapters=None):
+    """Yields (title, pages) for every chapter, where pages yields (content, images) for each page of that chapter.
+    chapters is a list of (title, page indexes), by default every chapter from get_chapters().
+    The pages of a chapter have to be consumed before moving on to the next chapter. Pages that are not in a chapter are never extracted."""
+    img_prefix = sanitize_filename(img_prefix)
+    if chapters is None:
+        chapters = get_chapters(doc, img_prefix)
+    page_indexes = [i for _, chapter_pages in chapters for i in chapter_pages]
+    if getattr(doc, "selected_pages", None) is None:
+        doc.selected_pages = page_indexes # the first call gets every selected page, later volumes only get the rest
+    pages = iter_pages(doc, page_indexes, img_prefix, pdf_hash)
+
+    try:
+        for toc_title, chapter_pages in chapters:
+            yield toc_title, itertools.islice(pages, len(chapter_pages))
+        # every page has been taken, this lets the page generators finish (progress bar, summaries, worker pools)
+        for _ in pages:
+            pass
+    finally:
+        pages.close() # when the caller stops early, e.g. to start a new volume
+
+def iter_pages(doc, page_indexes, img_prefix, pdf_hash=None):
+    """Yields (content, images) for every page in page_indexes, in order. Pages go through the page cache when pdf_hash is given."""
+    image_cache = ImageCache()
+    if CACHE_DIR and pdf_hash:
+        pages = PageCache(pdf_hash, img_prefix).iter_pages(doc, page_indexes, img_prefix, image_cache)
+    else:
+        pages = iter_extracted_pages(doc, page_indexes, img_prefix, image_cache)
+    if use_image_stage():
+        pages = iter_processed_pages(pages)
+    yield from track(pages, total=len(page_indexes), description=f"[cyan]Processing PDF...[/cyan]", console=console)
+
+def iter_extracted_pages(doc, page_indexes, img_prefix, image_cache):
+    if use_page_jobs(doc) and len(page_indexes) > 1:
+        # every worker has its own cache, duplicates between them are merged here
+        return (image_cache.merge_page(content, images) for content, images in iter_pages_parallel(doc, page_indexes, img_prefix))
+    return (extract_page_released(doc, i, img_prefix, image_cache) for i in page_indexes)
+
+def extract_page_released(doc, i, img_prefix, image_cache=None):
+    # layout and image stages run inside extract_page and are taken out of this one, so what's left is building the HTML
+    with profile_stage("html"):
+        content, images = extract_page(doc, i, img_prefix, image_cache)
+    # MuPDF keeps decoded images cached (up to 256MB) which would make memory grow with the book, not the page.
+    # only images fill it up, emptying it after text pages would just drop the fonts the next page needs again
+    if images:
+        pymupdf.TOOLS.store_shrink(100)
+    return content, images
+
+def use_page_jobs(doc):
+    # page workers open their own handle, so the document has to exist on disk
+    return PAGE_JOBS > 1 and doc.page_count > 1 and os.path.isfile(doc.name)
+
+def extract_pages_worker(pdf_path, pages, img_prefix, layout_index):
+    global WORKER_DOC, WORKER_IMAGE_CACHE
+    if WORKER_DOC is None or WORKER_DOC.name != pdf_path:
+        if WORKER_DOC is not None: WORKER_DOC.close()
+        WORKER_DOC = pymupdf.open(pdf_path)
+        WORKER_DOC.layout_index = layout_index
+        WORKER_IMAGE_CACHE = ImageCache()
+    return [(i, *extract_page_released(WORKER_DOC, i, img_prefix, WORKER_IMAGE_CACHE)) for i in pages]
+
+def iter_pages_parallel(doc, page_indexes, img_prefix):
+    # small chunks so a few slow pages don't hold up the rest, and only a few of them
+    # are in flight at once so finished pages don't pile up in memory
+    chunk_size = max(1, min(16, math.ceil(len(page_indexes) / (PAGE_JOBS * 4))))
+    chunks = iter([page_indexes[n:n + chunk_size] for n in range(0, len(page_indexes), chunk_size)])
+    debug_print("debug", f"extracting {len(page_indexes)} pages in chunks of {chunk_size} with {PAGE_JOBS} jobs")
+    layout_index = get_layout_index(doc) # built once here instead of in every worker
+
+    with ProcessPoolExecutor(max_workers=PAGE_JOBS, initializer=init_worker, initargs=(get_worker_settings(),)) as executor:
+        pending = collections.deque(executor.submit(extract_pages_worker, doc.name, chunk, img_prefix, layout_index)
+                                    for chunk in itertools.islice(chunks, PAGE_JOBS * 2))
+        while pending:
+            results = pending.popleft().result()
+            next_chunk = next(chunks, None)
+            if next_chunk:
+                pending.append(executor.submit(extract_pages_worker, doc.name, next_chunk, img_prefix, layout_index))
+            for i, content, images in results:
+                yield content, images
+
+def use_image_stage():
+    return IMAGE_MAX_SIZE is not None or JPEG_QUALITY is not None or GRAYSCALE_IMAGES
+
+def process_image(img_name, img_data):
+    """Downscales and recompresses an image for e-readers, following --image-max-size, --jpeg-quality and --grayscale.
+    Returns (file name, image data). JPEG images stay JPEG. When the image didn't have to be downscaled or made grayscale,
+    the original is kept if the result isn't smaller."""
+    try:
+        pix = pymupdf.Pixmap(img_data)
+        if pix.colorspace is None: # stencil masks and such
+            return img_name, img_data
+
+        changed = False
+        if IMAGE_MAX_SIZE is not None:
+            scale = min(1, IMAGE_MAX_SIZE[0] / pix.width, IMAGE_MAX_SIZE[1] / pix.height)
+            if scale < 1:
+                pix = pymupdf.Pixmap(pix, max(1, round(pix.width * scale)), max(1, round(pix.height * scale)))
+                changed = True
+        if GRAYSCALE_IMAGES and pix.colorspace.n > 1:
+            pix = pymupdf.Pixmap(pymupdf.csGRAY, pix)
+            changed = True
+        if pix.colorspace.n > 3: # CMYK: convert to RGB first
+            pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
+
+        # photos get a lot bigger as png, so jpeg sources stay jpeg. jpeg has no transparency
+        if (JPEG_QUALITY is not None or img_data.startswith(b"\xff\xd8\xff")) and not pix.alpha:
+            new_data, new_ext = pix.tobytes("jpeg", jpg_quality=JPEG_QUALITY or DEFAULT_JPEG_QUALITY), "jpeg"
+        else:
+            new_data, new_ext = pix.tobytes("png"), "png"
+    except Exception as e:
+        debug_print("error", f"Failed to process image {img_name}:\n{e}")
+        return img_name, img_data
+
+    if not changed and len(new_data) >= len(img_data):
+        return img_name, img_data
+    return f"{os.path.splitext(img_name)[0]}.{new_ext}", new_data
+
+def iter_processed_pages(pages):
+    """Runs process_image on the images of every page, with --image-jobs processes. Pages keep their order."""
+    renamed = {} # key: filename from extraction, value: filename after processing
+    bytes_before = 0
+    bytes_after = 0
+
+    def finish_page(content, processed):
+        nonlocal bytes_before, bytes_after
+        images = {}
+        for img_name, img_data, (new_name, new_data) in processed:
+            bytes_before += len(img_data)
+            bytes_after += len(new_data)
+            if new_name != img_name:
+                renamed[img_name] = new_name
+            images[new_name] = new_data
+        # later pages can point to an image of an earlier page, so every page is renamed
+        if renamed:
+            content = rename_img_src(content, renamed)
+        return content, images
+
+    if IMAGE_JOBS == 1:
+        for content, images in pages:
+            with profile_stage("image"):
+                processed = [(name, data, process_image(name, data)) for name, data in images.items()]
+            yield finish_page(content, processed)
+    else:
+        with ProcessPoolExecutor(max_workers=IMAGE_JOBS, initializer=init_worker, initargs=(get_worker_settings(),)) as executor:
+            pending = collections.deque()
+            for content, images in pages:
+                pending.append((content, [(name, data, executor.submit(process_image, name, data)) for name, data in images.items()]))
+                # extraction goes on while the images of the last few pages are processed
+                while len(pending) > IMAGE_JOBS * 2:
+                    content, futures = pending.popleft()
+                    yield finish_page(content, [(name, data, future.result()) for name, data, future in futures])
+            while pending:
+                content, futures = pending.popleft()
+                yield finish_page(content, [(name, data, future.result()) for name, data, future in futures])
+
+    if bytes_before:
+        debug_print("info", f"Image processing saved {format_size(bytes_before - bytes_after)} ({format_size(bytes_before)} -> {format_size(bytes_after)})")
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} GB"
 
-    with console.status(f"Saving {len(images)} images to {path}..."):
-        for i, (key, value) in enumerate(images.items()):
+def get_page_settings():
+    # every setting that changes what extract_page returns. the selection changes which pages the layout index is built from
+    return (CACHE_VERSION, HEADER_FOOTER_THRESHOLD, IGNORE_IMAGE_THRESHOLD, PASSTHROUGH_IMAGES, PAGE_SELECTION, CHAPTER_SELECTION)
+
+def get_output_settings(img_prefix, author):
+    # every setting that changes the EPUB (or the saved images) of a PDF
+    return repr((get_page_settings(), img_prefix, author, DO_SAVE_IMG, IMAGE_MAX_SIZE, JPEG_QUALITY, GRAYSCALE_IMAGES, PAGE_SELECTION, CHAPTER_SELECTION,
+                 MAX_CHAPTER_SIZE, PAGE_NAV))
+
+def write_file_atomic(path, data):
+    # other conversions may read or write the same cache file at the same time
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class PageCache:
+    """On-disk cache of extract_page results for one PDF, in CACHE_DIR.
+    Pages are stored under a hash of the PDF content, the page index and the page settings, with the names and hashes
+    of the images they reference. Images are stored once by their content hash."""
+
+    def __init__(self, pdf_hash, img_prefix):
+        self.pdf_hash = pdf_hash
+        self.img_prefix = img_prefix
+        self.settings = repr(get_page_settings())
+        self.image_hashes = {} # key: filename, value: content hash of every image yielded so far
+
+    def page_path(self, i):
+        key = hashlib.sha1(f"{self.pdf_hash}:{i}:{self.img_prefix}:{self.settings}".encode()).hexdigest()
+        return os.path.join(CACHE_DIR, "pages", key[:2], f"{key}.json")
+
+    def image_path(self, img_hash):
+        return os.path.join(CACHE_DIR, "images", img_hash[:2], img_hash)
+
+    def load(self, i, image_cache):
+        """Returns (content, images) for page i, deduplicated against image_cache. Raises OSError or ValueError if the entry is missing or broken."""
+        page_path = self.page_path(i)
+        with open(page_path, encoding="utf-8") as f:
+            entry = json.load(f)
+        os.utime(page_path) # keeps the entry from being pruned
+
+        # read every image before touching image_cache, so a missing one leaves the cache as it was
+        new_images = []
+        for img_name, img_hash in entry["images"]:
+            if img_hash not in image_cache.hashes:
+                with open(self.image_path(img_hash), "rb") as f:
+                    new_images.append((img_name, f.read()))
+                os.utime(self.image_path(img_hash))
+
+        images = {}
+        for img_name, img_data in new_images:
+            image_cache.add(images, img_name, img_data)
+        for img_name, img_hash in entry["images"]:
+            self.image_hashes[img_name] = img_hash
+            if image_cache.hashes[img_hash] != img_name:
+                image_cache.renamed[img_name] = image_cache.hashes[img_hash]
+
+        content = entry["content"]
+        if image_cache.renamed:
+            content = rename_img_src(content, image_cache.renamed)
+        return content, images
+
+    def store(self, i, content, images):
+        for img_name, img_data in images.items():
+            img_hash = hashlib.sha1(img_data).hexdigest()
+            self.image_hashes[img_name] = img_hash
+            if os.path.exists(self.image_path(img_hash)):
+                os.utime(self.image_path(img_hash))
+            else:
+                write_file_atomic(self.image_path(img_hash), img_data)
+
+        referenced = dict.fromkeys(IMG_SRC_PATTERN.findall(content))
+        if any(img_name not in self.image_hashes for img_name in referenced):
+            debug_print("debug", "page references an image that was not extracted, not caching it", i=i)
+            return
+        entry = {"content": content, "images": [(img_name, self.image_hashes[img_name]) for img_name in referenced]}
+        write_file_atomic(self.page_path(i), json.dumps(entry).encode("utf-8"))
+
+    def iter_pages(self, doc, page_indexes, img_prefix, image_cache):
+        """Yields (content, images) for every page in page_indexes. Cached pages are loaded, the rest are extracted and cached."""
+        missing = [i for i in page_indexes if not os.path.exists(self.page_path(i))]
+        if len(missing) < len(page_indexes):
+            debug_print("info", f"Loading {len(page_indexes) - len(missing)} of {len(page_indexes)} pages from cache")
+        missing_set = set(missing)
+        extracted = iter_extracted_pages(doc, missing, img_prefix, image_cache)
+
+        for i in page_indexes:
+            if i not in missing_set:
+                try:
+                    if PROFILER: PROFILER.start_page(i)
+                    with profile_stage("cache"):
+                        page = self.load(i, image_cache)
+                    yield page
+                    continue
+                except (OSError, ValueError, KeyError) as e: # pruned or broken entry, extract it again
+                    debug_print("debug", f"cache entry unusable, extracting again: {e}", i=i)
+                    content, images = extract_page_released(doc, i, img_prefix, image_cache)
+            else:
+                content, images = next(extracted)
             try:
-                with open(f"{path}/{key}", "wb") as f:
-                    f.write(value)
-            except Exception as e:
-                debug_print("error", f"Error saving image {i} at {path}\\{key}. Full error below.\n{e}")
+                with profile_stage("cache"):
+                    self.store(i, content, images)
+            except OSError as e:
+                debug_print("warning", f"Failed to write page cache: {e}", i=i)
+            yield content, images
+
+def get_pdf_hash(pdf_path, manifest=None):
+    """Content hash of the PDF. Reuses the hash in the manifest if the file's size and modification time haven't changed."""
+    stat = os.stat(pdf_path)
+    if manifest and manifest.get("pdf_size") == stat.st_size and manifest.get("pdf_mtime") == stat.st_mtime_ns:
+        return manifest["pdf_hash"]
+    with open(pdf_path, "rb") as f:
+        return hashlib.file_digest(f, "sha1").hexdigest()
+
+def get_manifest_path(output_epub):
+    key = hashlib.sha1(os.path.abspath(output_epub).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, "manifest", f"{key}.json")
+
+def read_manifest(output_epub):
+    try:
+        with open(get_manifest_path(output_epub), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_manifest(output_epub, pdf_path, pdf_hash, settings):
+    """pdf_path is None when the PDF was not read from a file."""
+    epub_stat = os.stat(output_epub)
+    manifest = {"pdf": None, "pdf_hash": pdf_hash, "settings": settings, "epub_size": epub_stat.st_size, "epub_mtime": epub_stat.st_mtime_ns}
+    if pdf_path is not None:
+        pdf_stat = os.stat(pdf_path)
+        manifest.update({"pdf": os.path.abspath(pdf_path), "pdf_size": pdf_stat.st_size, "pdf_mtime": pdf_stat.st_mtime_ns})
+    write_file_atomic(get_manifest_path(output_epub), json.dumps(manifest).encode("utf-8"))
+
+def is_up_to_date(manifest, output_epub, pdf_hash, settings):
+    """True if output_epub was written from this PDF with these settings and hasn't been changed since."""
+    if not manifest or manifest["pdf_hash"] != pdf_hash or manifest["settings"] != settings:
+        return False
+    try:
+        epub_stat = os.stat(output_epub)
+    except OSError:
+        return False
+    return epub_stat.st_size == manifest["epub_size"] and epub_stat.st_mtime_ns == manifest["epub_mtime"]
+
+def prune_cache(cache_dir, max_size):
+    """Removes the least recently used page and image entries until the cache fits in max_size bytes,
+    and the oldest --analyze calibration runs."""
+    trim_runs(cache_dir)
+    entries = [] # (last used, size, path)
+    for folder in ("pages", "images"):
+        for root, dirs, files in os.walk(os.path.join(cache_dir, folder)):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+    cache_size = sum(size for _, size, _ in entries)
+    debug_print("debug", f"page cache is {format_size(cache_size)}, limit is {format_size(max_size)}")
+    if cache_size <= max_size:
+        return
+
+    removed = 0
+    for _, size, path in sorted(entries):
+        if cache_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        cache_size -= size
+        removed += size
+    debug_print("info", f"Removed {format_size(removed)} of old entries from the page cache")
+
+def get_stream_size(doc, xref):
+    """Size of a stream as stored in the file, from its /Length, without reading or decoding it.
+    Streams without a filter are counted as if they were deflated, which is about what they become in the EPUB."""
+    kind, value = doc.xref_get_key(xref, "Length")
+    if kind == "xref": # indirect length, e.g. "12 0 R"
+        value = doc.xref_object(int(value.split()[0]))
+    try:
+        size = int(value)
+    except ValueError:
+        size = len(doc.xref_stream_raw(xref) or b"")
+    if doc.xref_get_key(xref, "Filter")[0] == "null":
+        size = round(size * UNFILTERED_STREAM_RATIO)
+    return size
+
+def get_pdf_stats(doc):
+    """What the --analyze estimates are based on, read from the page tree, TOC and stream dictionaries only.
+    Only ANALYZE_SAMPLE_PAGES random pages are read, the rest is extrapolated from them."""
+    # random instead of every nth page, which could keep hitting the same kind of page in books with a repeating layout
+    sampled = sorted(random.Random(doc.page_count).sample(range(doc.page_count), min(doc.page_count, ANALYZE_SAMPLE_PAGES)))
+    content_bytes = 0
+    images = {} # key: xref, value: [pages it is on, stream size, pixels, passthrough]
+    for pno in sampled:
+        kind, value = doc.xref_get_key(doc.page_xref(pno), "Contents")
+        if kind in ("xref", "array"):
+            content_bytes += sum(get_stream_size(doc, int(xref)) for xref in re.findall(r"(\d+) 0 R", value))
+        for img in doc.get_page_images(pno, full=True):
+            xref, smask, width, height, _, colorspace, _, _, img_filter, _ = img
+            if xref in images:
+                images[xref][0] += 1
+                continue
+            # the same test extract_img_from_xref makes, as far as the image dictionary tells
+            passthrough = PASSTHROUGH_IMAGES and img_filter == "DCTDecode" and not smask and colorspace != "DeviceCMYK"
+            images[xref] = [1, get_stream_size(doc, xref), width * height, passthrough]
+
+    # images found on one sampled page are probably on that page only, those on several are probably on all of them
+    scale = doc.page_count / len(sampled) if sampled else 0
+    stats = collections.Counter(pages=doc.page_count, content_bytes=content_bytes * scale, images=0, passthrough_bytes=0,
+                                reencode_bytes=0, largest_image_pixels=0)
+    for pages, size, pixels, passthrough in images.values():
+        count = scale if pages == 1 else 1
+        stats["images"] += count
+        if passthrough:
+            stats["passthrough_bytes"] += size * count
+        else: # decoded and encoded as png
+            stats["reencode_bytes"] += size * count
+        stats["largest_image_pixels"] = max(stats["largest_image_pixels"], pixels)
+
+    # every chapter is kept in memory until it is written
+    chapter_starts = sorted({0, doc.page_count} | {item[2] - 1 for item in doc.get_toc() if item[1].strip() and 0 < item[2] <= doc.page_count})
+    stats["chapters"] = len(chapter_starts) - 1
+    largest_chapter_pages = max((end - start for start, end in itertools.pairwise(chapter_starts)), default=0)
+    stats["largest_chapter_bytes"] = content_bytes / len(sampled) * largest_chapter_pages if sampled else 0
+    return {feature: round(value) for feature, value in stats.items()}
+
+def estimate_conversion(stats, calibration=None):
+    """Estimated seconds, EPUB bytes and peak memory bytes of converting a PDF with one job and without the page cache."""
+    calibration = calibration or {}
+    estimate = {}
+    for target, model in ESTIMATE_MODEL.items():
+        value = model["base"] + sum(weight * stats.get(feature, 0) for feature, weight in model.items() if feature != "base")
+        estimate[target] = value * calibration.get(target, 1)
+    return estimate
+
+def get_runs_path(cache_dir):
+    return os.path.join(cache_dir, "runs.jsonl")
+
+def record_run(stats, seconds, output_size):
+    """Adds a finished conversion to the runs --analyze calibrates its estimates with."""
+    line = json.dumps({"stats": stats, "time": seconds, "size": output_size}) + "\n"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # lines this short are appended in one write, so parallel conversions don't mix them up
+        with open(get_runs_path(CACHE_DIR), "a", encoding="utf-8") as f:
+            f.write(line)
+    except OSError as e:
+        debug_print("debug", f"Failed to record run: {e}")
+
+def read_runs(cache_dir):
+    try:
+        with open(get_runs_path(cache_dir), encoding="utf-8") as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+    runs = []
+    for line in lines[-ANALYZE_MAX_RUNS:]:
+        try:
+            runs.append(json.loads(line))
+        except ValueError: # cut off by a crash
+            continue
+    return runs
+
+def trim_runs(cache_dir):
+    runs_path = get_runs_path(cache_dir)
+    try:
+        if os.path.getsize(runs_path) < 1024 * 1024:
+            return
+    except OSError:
+        return
+    runs = read_runs(cache_dir)
+    write_file_atomic(runs_path, "".join(json.dumps(run) + "\n" for run in runs).encode("utf-8"))
+
+def get_calibration(runs):
+    """How far off the estimates were for the recorded runs: median of measured / estimated, per target.
+    Peak memory isn't recorded, workers are reused for several PDFs so their peak isn't the one of a single conversion."""
+    calibration = {}
+    for target in ("time", "size"):
+        ratios = sorted(run[target] / estimate for run in runs
+                        if (estimate := estimate_conversion(run["stats"])[target]) > 0 and run[target] > 0)
+        if len(ratios) >= 3:
+            calibration[target] = ratios[len(ratios) // 2]
+    return calibration
+
+def is_calibration_run(doc, pdf_path, pdf_hash, img_prefix):
+    """Whether the conversion runs the way --analyze estimates it, so it can be recorded to calibrate the estimates:
+    every page extracted from a PDF file, with one job, default image settings, no saved images and nothing from the page cache."""
+    if not CACHE_DIR or pdf_path is None or not doc.page_count or PROFILER or PIPELINE or DO_SAVE_IMG:
+        return False
+    if PAGE_JOBS > 1 or use_image_stage() or PAGE_SELECTION or CHAPTER_SELECTION or MAX_VOLUME_PAGES or MAX_VOLUME_SIZE:
+        return False
+    # pages are cached all at once, so the first one tells if this PDF was converted with these settings before
+    return not os.path.exists(PageCache(pdf_hash, sanitize_filename(img_prefix)).page_path(0))
+
+def analyze_worker(pdf_path):
+    try:
+        with pymupdf.open(pdf_path) as doc:
+            if doc.needs_pass:
+                return pdf_path, None, "Encrypted"
+            return pdf_path, get_pdf_stats(doc), None
+    except Exception as e:
+        return pdf_path, None, f"{type(e).__name__}: {e}"
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(round(seconds), 60)
+    return f"{minutes}m {seconds:02d}s" if minutes < 60 else f"{minutes // 60}h {minutes % 60:02d}m"
+
+def analyze_pdfs(pdf_paths, output, jobs):
+    """--analyze: prints estimated conversion time, EPUB size and peak memory of every PDF without converting any of them."""
+    time_start = perf_counter()
+    if jobs > 1 and len(pdf_paths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(get_worker_settings(),)) as executor:
+            results = list(executor.map(analyze_worker, pdf_paths, chunksize=max(1, min(64, len(pdf_paths) // (jobs * 4)))))
+    else:
+        results = [analyze_worker(pdf_path) for pdf_path in track(pdf_paths, description="[cyan]Analyzing PDFs...[/cyan]", console=console)]
+
+    runs = read_runs(CACHE_DIR) if CACHE_DIR else []
+    calibration = get_calibration(runs)
+    table = Table(title="Estimates", title_justify="left")
+    table.add_column("PDF", overflow="fold")
+    for column in ("Pages", "Chapters", "Images", "Time", "EPUB size", "Peak memory"):
+        table.add_column(column, justify="right")
+
+    total_time = total_size = failed = 0
+    for pdf_path, stats, error in results:
+        if stats is None:
+            failed += 1
+            table.add_row(pdf_path, "[bright_red]failed[/bright_red]", "", "", "", "", error)
+            continue
+        estimate = estimate_conversion(stats, calibration)
+        total_time += estimate["time"]
+        total_size += estimate["size"]
+        table.add_row(pdf_path, str(stats["pages"]), str(stats["chapters"]), str(stats["images"]),
+                      format_duration(estimate["time"]), format_size(estimate["size"]), format_size(estimate["memory"]))
+
+    debug_print("spacing", "")
+    console.print(table)
+    if calibration:
+        debug_print("info", f"Calibrated with {len(runs)} earlier conversions: times x{calibration.get("time", 1):.2f}, sizes x{calibration.get("size", 1):.2f}")
+    else:
+        debug_print("info", "Not calibrated yet, estimates are for a typical machine. Conversions with --page-jobs 1 and default image settings are recorded to calibrate them")
+    if PAGE_JOBS > 1 or use_image_stage() or not PASSTHROUGH_IMAGES:
+        debug_print("warning", "Estimates are for --page-jobs 1 and the default image settings")
+    if failed:
+        debug_print("error", f"{failed} of {len(results)} PDFs could not be analyzed")
+
+    debug_print("success", f"{len(results) - failed} PDFs: about {format_duration(total_time)} and {format_size(total_size)} in total")
+    # every job converts one PDF at a time, so the largest ones decide how much memory --jobs needs
+    job_memory = sorted((estimate_conversion(stats, calibration)["memory"] for _, stats, _ in results if stats), reverse=True)
+    for job_count in sorted({1, jobs, os.cpu_count() or 1}):
+        debug_print("info", f"With --jobs {job_count}: about {format_duration(total_time / job_count)}, "
+                            f"up to {format_size(sum(job_memory[:job_count]))} of memory")
+    if output != "-":
+        output_disk = os.path.abspath(output)
+        while not os.path.exists(output_disk): # the output folder is only created when converting
+            output_disk = os.path.dirname(output_disk)
+        free = shutil.disk_usage(output_disk).free
+        debug_print("info" if free > total_size else "warning", f"{format_size(free)} free in {output}")
+    debug_print("info", f"Analyzed in {perf_counter() - time_start:.3f} seconds")
+
+class Profiler:
+    """Collects wall time, CPU time and allocated bytes of every stage, per document, chapter and page (--profile).
+    Times are exclusive: time spent in a stage that runs inside another one only counts for the inner stage.
+    Allocated bytes are the most Python memory in use above what was in use when the stage started, traced with tracemalloc,
+    so memory allocated by MuPDF itself is not included."""
+
+    def __init__(self):
+        self.documents = []
+        self.document = None
+        self.chapter = None
+        self.page = None
+        self.running = [] # stages that are running, innermost last
+        self.totals = {}
+        tracemalloc.start()
+
+    def start_document(self, pdf_path):
+        self.document = {"pdf": pdf_path, "status": None, "wall": 0, "stages": {}, "chapters": []}
+        self.chapter = self.page = None
+        self.documents.append(self.document)
+        self.document_start = perf_counter()
 
-    debug_print("info", f"Saved {len(images)} images to {path}")
+    def end_document(self, status):
+        self.document["status"] = status
+        self.document["wall"] = perf_counter() - self.document_start
+        self.document = self.chapter = self.page = None
 
-def pdf_to_epub(pdf_path, output, img_prefix="", author=None):
+    def start_chapter(self, title):
+        self.chapter = {"title": title, "stages": {}, "pages": []}
+        self.page = None
+        if self.document:
+            self.document["chapters"].append(self.chapter)
+
+    def start_page(self, i):
+        if self.page and self.page["page"] == i + 1: # a cached page that had to be extracted again
+            return
+        self.page = {"page": i + 1, "stages": {}}
+        if self.chapter:
+            self.chapter["pages"].append(self.page)
+
+    def end_page(self):
+        self.page = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.running: # keep the outer stage's peak before it is reset
+            self.running[-1]["peak"] = max(self.running[-1]["peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        stage = {"inner_wall": 0, "inner_cpu": 0, "peak": 0}
+        self.running.append(stage)
+        alloc_start = tracemalloc.get_traced_memory()[0]
+        wall_start, cpu_start = perf_counter(), process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = perf_counter() - wall_start, process_time() - cpu_start
+            peak = max(stage["peak"], tracemalloc.get_traced_memory()[1])
+            self.running.pop()
+            if self.running:
+                outer = self.running[-1]
+                outer["inner_wall"] += wall
+                outer["inner_cpu"] += cpu
+                outer["peak"] = max(outer["peak"], peak)
+            tracemalloc.reset_peak()
+            self.add(name, wall - stage["inner_wall"], cpu - stage["inner_cpu"], max(0, peak - alloc_start))
+
+    def add(self, name, wall, cpu, alloc):
+        for record in (self.totals, self.document, self.chapter, self.page):
+            if record is None:
+                continue
+            stages = record if record is self.totals else record["stages"]
+            stats = stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "alloc": 0})
+            stats["calls"] += 1
+            stats["wall"] += wall
+            stats["cpu"] += cpu
+            stats["alloc"] += alloc
+
+    def save(self, path):
+        tracemalloc.stop()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"stages": self.totals, "documents": self.documents}, f, indent=1)
+        except OSError as e:
+            debug_print("error", f"Failed to save profile to {path}: {e}")
+            return
+
+        table = Table(title="Profile", title_justify="left")
+        for column in ("Stage", "Calls", "Wall (s)", "CPU (s)", "Allocated"):
+            table.add_column(column, justify="left" if column == "Stage" else "right")
+        for name, stats in sorted(self.totals.items(), key=lambda item: item[1]["wall"], reverse=True):
+            table.add_row(name, str(stats["calls"]), f"{stats['wall']:.3f}", f"{stats['cpu']:.3f}", format_size(stats["alloc"]))
+        debug_print("spacing", "")
+        console.print(table)
+        debug_print("info", f"Saved profile to {path}")
+
+def profile_stage(name):
+    # a shared no-op context when --profile isn't used, so stages cost next to nothing
+    return PROFILER.stage(name) if PROFILER else NO_PROFILE
+
+def handle_save_images(images, path):
+    """Saves a dict of images (key: filename, value: image data) to path. Returns how many were saved."""
+    os.makedirs(f"{path}", exist_ok=True)
+
+    saved = 0
+    for i, (key, value) in enumerate(images.items()):
+        try:
+            with open(f"{path}/{key}", "wb") as f:
+                f.write(value)
+            saved += 1
+        except Exception as e:
+            debug_print("error", f"Error saving image {i} at {path}\\{key}. Full error below.\n{e}")
+
+    return saved
+
+def queue_chapter_part(write_queue, writer, title, part, number, page_nav=False):
+    """Queues a part from ChapterParts. With page_nav every part is a chapter of its own, named after its pages."""
+    content, first_page, last_page = part
+    if page_nav and first_page is not None:
+        title = f"Page {first_page + 1}" if first_page == last_page else f"Pages {first_page + 1}-{last_page + 1}"
+        number = 0
+    with profile_stage("epub_write"):
+        write_queue.put(writer.add_chapter, title, content, number)
+
+def get_volume_path(output_epub, volume):
+    base, ext = os.path.splitext(output_epub)
+    return f"{base} - Volume {volume}{ext}"
+
+def is_volume_full(volume_size, volume_pages, chapter_pages):
+    """Whether the next chapter starts a new volume (--max-volume-pages, --max-volume-size).
+    Chapters are never split, so a chapter over the limit gets a volume of its own."""
+    if volume_pages == 0:
+        return False
+    if MAX_VOLUME_PAGES and volume_pages + chapter_pages > MAX_VOLUME_PAGES:
+        return True
+    # the size of the next chapter is guessed from the pages written so far
+    return bool(MAX_VOLUME_SIZE) and volume_size + volume_size / volume_pages * chapter_pages > MAX_VOLUME_SIZE
+
+def is_path(value):
+    return isinstance(value, (str, os.PathLike))
+
+def read_pdf_data(pdf):
+    """PDF data from bytes, bytearray, memoryview, mmap or a binary stream such as sys.stdin.buffer.
+    Returned as a memoryview so pymupdf uses bytes-like data without copying it."""
+    if hasattr(pdf, "read") and not isinstance(pdf, mmap.mmap):
+        pdf = pdf.read()
+    return memoryview(pdf)
+
+def pdf_to_epub(pdf, output, img_prefix="", author=None, name=None):
+    """Converts pdf (a file path, bytes-like data or a binary stream) into an EPUB.
+    output is the folder to write it to, or a binary stream (e.g. sys.stdout.buffer) to write the EPUB into.
+    name is used for the title, image prefix and output file name when pdf isn't a file path. Default: "stdin" for stdin, "document" otherwise.
+    Returns (status, detail) where status is one of "converted", "skipped" or "failed"."""
     global DO_SAVE_IMG, DEBUG_MODE
+    time_start = perf_counter()
+    pdf_path = pdf if is_path(pdf) else None
+    to_stream = not is_path(output)
+    split_volumes = bool(MAX_VOLUME_PAGES or MAX_VOLUME_SIZE) and not to_stream
+    if to_stream and (MAX_VOLUME_PAGES or MAX_VOLUME_SIZE):
+        debug_print("warning", "Volumes can't be split when the EPUB is written to a stream, writing one EPUB")
 
     try:
-        doc = pymupdf.open(pdf_path)
+        with profile_stage("open"):
+            if pdf_path is not None:
+                doc = pymupdf.open(pdf_path)
+            else:
+                pdf_data = read_pdf_data(pdf)
+                doc = pymupdf.open("pdf", pdf_data)
     except Exception as e:
-        debug_print("error", f"Failed to open PDF {pdf_path}: \n{e}")
-        return
+        debug_print("error", f"Failed to open PDF {pdf_path if pdf_path else name}: \n{e}")
+        return "failed", f"Failed to open PDF: {e}"
     
     try:
-        pdf_filename = os.path.splitext(os.path.basename(pdf_path))[0].strip()
+        if pdf_path is not None:
+            pdf_filename = os.path.splitext(os.path.basename(pdf_path))[0].strip()
+        else:
+            pdf_filename = name if name else ("stdin" if pdf is sys.stdin.buffer else "document")
+        output_epub = getattr(output, "name", "stream") if to_stream else os.path.join(output, f"{pdf_filename}.epub")
+        base_epub = output_epub
+        if split_volumes:
+            output_epub = get_volume_path(base_epub, 1)
+        img_prefix = img_prefix if img_prefix else pdf_filename
+        pdf_hash = None
+        if CACHE_DIR:
+            # the manifest needs an EPUB file to compare against, the page cache only needs the PDF
+            output_settings = get_output_settings(img_prefix, author)
+            # volumes are checked by the settings of the first one only, so they are always converted
+            manifest = None if to_stream or split_volumes else read_manifest(output_epub)
+            pdf_hash = get_pdf_hash(pdf_path, manifest) if pdf_path is not None else hashlib.sha1(pdf_data).hexdigest()
+            if is_up_to_date(manifest, output_epub, pdf_hash, output_settings):
+                debug_print("info", f"Skipping {output_epub}, it is up to date")
+                return "skipped", f"{output_epub} is up to date"
+        if not to_stream and SKIP_ALL_FILES and not SHOULD_OVERWRITE and os.path.exists(output_epub):
+            debug_print("info", f"Skipping {output_epub}")
+            return "skipped", f"{output_epub} already exists"
         
         debug_print("spacing", "")
         console.print(Rule(f"[bold white]Processing {pdf_filename}[/bold white]", style="bold white", align="left"))
         debug_print("spacing", "")
-        chapters = extract_with_toc(doc, img_prefix if img_prefix else pdf_filename)
-
-        cover_image_name, cover_image_data = ("", "")
-        try:
-            cover_image_name = next(iter(chapters[0][2].keys()))
-            cover_image_data = chapters[0][2][cover_image_name]
-        except IndexError:
-            debug_print("warning", "No cover image detected")
-
-        output_epub = os.path.join(output, f"{pdf_filename}.epub")
 
         doc_author = author if author else doc.metadata.get("author", "")
         debug_print("debug", f"User selected author: {author} / Detected author: {doc.metadata.get("author", "")}")
@@ -476,19 +1998,102 @@ def pdf_to_epub(pdf_path, output, img_prefix="", author=None):
         if doc_title == "":
             doc_title = pdf_filename
 
+        # the output file is picked before extracting so chapters can be written as soon as they are extracted
+        final_path = output_epub if to_stream else handle_file_overwrite(output_epub)
+        if not final_path:
+            debug_print("info", f"Skipping {output_epub}")
+            return "skipped", f"{output_epub} already exists"
+
+        calibration_run = is_calibration_run(doc, pdf_path, pdf_hash, img_prefix)
+        page_nav = PAGE_NAV and not doc.get_toc()
+        writer = None
+        write_queue = WriteQueue(threaded=PIPELINE)
         try:
-            final_path = handle_file_overwrite(output_epub)
-            if final_path:
-                if DO_SAVE_IMG:
-                    debug_print("spacing", "")
-                    img_output_dir = os.path.normpath(f"{os.path.splitext(final_path)[0]}_images")
-                    handle_save_images(chapters, img_output_dir)
-
-                create_epub(chapters, final_path, doc_title, doc_author, (cover_image_name, cover_image_data))
-            else:
-                debug_print("info", f"Skipping {output_epub}")
+            img_output_dir = None
+            image_saves = [] # futures of the number of images saved per page
+            if DO_SAVE_IMG and to_stream:
+                debug_print("warning", "Images are not saved when the EPUB is written to a stream")
+            elif DO_SAVE_IMG:
+                img_output_dir = os.path.normpath(f"{os.path.splitext(final_path)[0]}_images")
+                debug_print("debug", f"Saving images to {img_output_dir}")
+
+            chapters = get_chapters(doc, sanitize_filename(img_prefix))
+            if not chapters:
+                debug_print("warning", "No pages selected")
+            volume_paths = []
+            cover = None
+            # every volume extracts its chapters with a new page iterator and image cache, so it has all of its own images
+            while chapters or not volume_paths:
+                volume_title = doc_title
+                if volume_paths:
+                    final_path = handle_file_overwrite(get_volume_path(base_epub, len(volume_paths) + 1))
+                    if not final_path:
+                        debug_print("info", f"Skipping the remaining volumes of {base_epub}")
+                        return "skipped", f"Stopped after {len(volume_paths)} volumes: {", ".join(volume_paths)}"
+                if split_volumes:
+                    volume_title = f"{doc_title} - Volume {len(volume_paths) + 1}"
+                writer = EpubStreamWriter(output if to_stream else final_path, volume_title, doc_author)
+                if cover:
+                    write_queue.put(writer.set_cover, *cover)
+                volume_pages = 0
+                volume_chapters = iter_chapters(doc, img_prefix, pdf_hash, chapters)
+                for chapter_index, (toc_title, pages) in enumerate(volume_chapters):
+                    chapter_pages = len(chapters[chapter_index][1])
+                    if split_volumes:
+                        write_queue.join() # the size has to include everything written so far
+                        if is_volume_full(writer.size, volume_pages, chapter_pages):
+                            break
+                    if PROFILER: PROFILER.start_chapter(toc_title)
+                    parts = ChapterParts()
+                    for page_index, (page_content, page_images) in zip(chapters[chapter_index][1], pages):
+                        if page_images and not volume_paths and chapter_index == 0 and not cover:
+                            cover = next(iter(page_images.items())) # later volumes get the same cover
+                            with profile_stage("epub_write"):
+                                write_queue.put(writer.set_cover, *cover)
+                        if page_images:
+                            image_saves.append(write_queue.put(write_page_images, writer, page_images, img_output_dir))
+                        for part in parts.add(page_content, page_index):
+                            queue_chapter_part(write_queue, writer, toc_title, part, parts.count - 1, page_nav)
+                        if PROFILER: PROFILER.end_page()
+                    for part in parts.close():
+                        queue_chapter_part(write_queue, writer, toc_title, part, parts.count - 1, page_nav)
+                    volume_pages += chapter_pages
+
+                    if not volume_paths and chapter_index == 0 and not cover:
+                        debug_print("warning", "No cover image detected")
+                else:
+                    chapter_index = len(chapters)
+                volume_chapters.close()
+                chapters = chapters[chapter_index:]
+
+                write_queue.join()
+                with profile_stage("epub_write"):
+                    closed = writer.close()
+                writer = None
+                if not closed:
+                    return "failed", f"Failed to write EPUB {final_path}"
+                volume_paths.append(final_path)
+                if split_volumes:
+                    debug_print("info", f"Volume {len(volume_paths)}: {volume_pages} pages")
+
+            write_queue.close()
+            if img_output_dir:
+                debug_print("info", f"Saved {sum(future.result() for future in image_saves)} images to {img_output_dir}")
+            if CACHE_DIR and not to_stream and not split_volumes:
+                try:
+                    write_manifest(final_path, pdf_path, pdf_hash, output_settings)
+                except OSError as e:
+                    debug_print("warning", f"Failed to write cache manifest: {e}")
+            if calibration_run and not to_stream:
+                seconds = perf_counter() - time_start
+                record_run(get_pdf_stats(doc), seconds, os.path.getsize(final_path))
+            return "converted", ", ".join(volume_paths)
         except Exception as e:
-            debug_print("error", f"Failed to create EPUB {output_epub}:\n{e}")
+            debug_print("error", f"Failed to create EPUB {final_path}:\n{e}")
+            return "failed", f"Failed to create EPUB: {e}"
+        finally:
+            write_queue.close(cancel=True) # stops the writer thread when a volume was skipped
+            if writer: writer.abort() # also on ctrl+c, so no .part file is left behind
     finally:
         doc.close()
 
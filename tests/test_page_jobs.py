@@ -0,0 +1,54 @@
+import re
+import zipfile
+import pymupdf
+import main
+from main import Settings, pdf_to_epub
+
+MODIFIED_PATTERN = re.compile(rb"<meta property=\"dcterms:modified\">[^<]*</meta>")
+
+
+def make_pdf(path):
+    """12 pages in 3 chapters, with a logo repeated on every page and a unique image on every other page."""
+    logo = pymupdf.Pixmap(pymupdf.csRGB, pymupdf.IRect(0, 0, 64, 32), False)
+    logo.set_rect(logo.irect, (200, 40, 40))
+    doc = pymupdf.open()
+    toc = []
+    for p in range(12):
+        page = doc.new_page()
+        for line in range(20):
+            page.insert_text((72, 120 + line * 14), f"Line {line} of page {p + 1}, with some words to fill it.", fontsize=10)
+        page.insert_image(pymupdf.Rect(72, 420, 200, 484), pixmap=logo)
+        if p % 2 == 0:
+            image = pymupdf.Pixmap(pymupdf.csRGB, pymupdf.IRect(0, 0, 48, 48), False)
+            image.set_rect(image.irect, (p * 20, 100, 255 - p * 20))
+            page.insert_image(pymupdf.Rect(300, 420, 396, 516), pixmap=image)
+        if p % 4 == 0:
+            toc.append([1, f"Chapter {p // 4 + 1}", p + 1])
+    doc.set_toc(toc)
+    doc.save(path)
+    doc.close()
+
+def read_epub(path):
+    with zipfile.ZipFile(path) as epub:
+        return {name: MODIFIED_PATTERN.sub(b"", epub.read(name)) for name in epub.namelist()}
+
+def convert(monkeypatch, pdf_path, output, page_jobs):
+    for name, value in Settings(cache_dir=None, if_exists="overwrite", page_jobs=page_jobs).to_globals().items():
+        monkeypatch.setattr(main, name, value)
+    status, detail = pdf_to_epub(str(pdf_path), str(output))
+    assert status == "converted", detail
+    return read_epub(detail)
+
+def test_page_jobs_output_matches_serial(monkeypatch, tmp_path):
+    pdf_path = tmp_path / "book.pdf"
+    make_pdf(pdf_path)
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+
+    serial = convert(monkeypatch, pdf_path, tmp_path / "serial", 1)
+    parallel = convert(monkeypatch, pdf_path, tmp_path / "parallel", 3)
+
+    assert len([name for name in serial if name.startswith("EPUB/images/")]) == 7 # the logo once and 6 unique images
+    assert list(parallel) == list(serial)
+    for name in serial:
+        assert parallel[name] == serial[name], name